@@ -1,8 +1,14 @@
 """
   Internal bus for communication among modules
 """
-from queue import Queue
+import time
+from bisect import bisect_left
+from collections import deque
+from datetime import timedelta
+from queue import Queue, Empty
+from threading import Condition
 
+from osgar.lib.logger import INFO_STREAM_ID
 from osgar.lib.serialize import serialize, deserialize
 
 
@@ -10,32 +16,286 @@ class BusShutdownException(Exception):
     pass
 
 
+def check_log_policy(policy):
+    "logging policy is 'all', 'none', {'every': N} or {'max_rate': Hz}"
+    assert policy in ['all', 'none'] or (
+            isinstance(policy, dict) and len(policy) == 1 and
+            (policy.get('every', 0) >= 1 or policy.get('max_rate', 0) > 0)), policy
+    return policy
+
+
+def check_link_policy(policy):
+    "delivery policy of link is 'fifo', {'max_size': N} (drop oldest) or 'latest'"
+    assert policy in ['fifo', 'latest'] or (
+            isinstance(policy, dict) and list(policy.keys()) == ['max_size'] and
+            policy['max_size'] >= 1), policy
+    return policy
+
+
+LATENCY_BOUNDS = [10, 100, 1000, 10000, 100000, 1000000]  # microseconds, upper bounds of histogram buckets
+
+
+class Histogram:
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        "counts of values in fixed buckets, the last one is above all bounds"
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+
+    def add(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+
+
+class LinkStats:
+    def __init__(self):
+        "statistics of one input channel"
+        self.count = 0  # received messages
+        self.dropped = 0
+        self.max_depth = 0
+        self.latency = Histogram()
+
+    def as_dict(self):
+        return {'count': self.count, 'dropped': self.dropped, 'max_depth': self.max_depth,
+                'latency': self.latency.counts}
+
+
+class Mailbox:
+    def __init__(self):
+        """
+        Input queue of the module with delivery policy for every input channel.
+        The messages are kept in deques (bounded for 'max_size' and 'latest')
+        and they are returned in the order of arrival.
+          For every channel are collected statistics (LinkStats): number of
+        received and dropped messages, the maximal queue depth and histogram
+        of the latency between put() and get() in microseconds.
+        """
+        self.condition = Condition()
+        self.channels = {}  # channel -> deque of (sequence number, put time, packet)
+        self.policies = {}
+        self.stats = {}
+        self.seq = 0
+
+    def set_policy(self, channel, policy):
+        assert self.policies.get(channel, policy) == policy, (channel, self.policies[channel], policy)
+        check_link_policy(policy)
+        self.policies[channel] = policy
+        maxlen = 1 if policy == 'latest' else None if policy == 'fifo' else policy['max_size']
+        with self.condition:
+            self.channels[channel] = deque(self.channels.get(channel, []), maxlen=maxlen)
+
+    def put(self, packet):
+        "store (timestamp, channel, data) or None (shutdown)"
+        with self.condition:
+            self.store(packet, time.monotonic())
+            self.condition.notify()
+
+    def put_many(self, packets):
+        "store several (timestamp, channel, data) at once"
+        now = time.monotonic()
+        with self.condition:
+            for packet in packets:
+                self.store(packet, now)
+            self.condition.notify()
+
+    def store(self, packet, put_time):
+        channel = None if packet is None else packet[1]
+        messages = self.channels.get(channel)
+        if messages is None:
+            messages = self.channels[channel] = deque()
+        stats = self.link_stats(channel)
+        if len(messages) == messages.maxlen:
+            stats.dropped += 1
+        messages.append((self.seq, put_time, packet))  # the oldest is dropped for full bounded deque
+        stats.max_depth = max(stats.max_depth, len(messages))
+        self.seq += 1
+
+    def link_stats(self, channel):
+        stats = self.stats.get(channel)
+        if stats is None:
+            stats = self.stats[channel] = LinkStats()
+        return stats
+
+    def get(self, timeout=None):
+        "return the oldest stored packet, wait if there is none (raise Empty after timeout)"
+        return self.get_many(1, timeout)[0]
+
+    def get_many(self, max_items=None, timeout=None):
+        """
+        return list of the oldest stored packets (at most max_items), wait
+        for at least one (raise Empty after timeout in seconds). The shutdown
+        (None) is returned alone.
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: not self.empty(), timeout):
+                raise Empty()
+            ret = []
+            now = time.monotonic()
+            while max_items is None or len(ret) < max_items:
+                heads = [messages for messages in self.channels.values() if len(messages) > 0]
+                if len(heads) == 0:
+                    break
+                messages = min(heads, key=lambda messages: messages[0][0])
+                if messages[0][2] is None and len(ret) > 0:
+                    break  # shutdown is returned by the next call
+                __, put_time, packet = messages.popleft()
+                ret.append(packet)
+                if packet is None:
+                    break
+                stats = self.link_stats(packet[1])
+                stats.count += 1
+                stats.latency.add(int((now - put_time) * 1000000))
+            return ret
+
+    def empty(self):
+        with self.condition:
+            return all(len(messages) == 0 for messages in self.channels.values())
+
+    def get_stats(self, reset=False):
+        "return dictionary channel -> statistics (see LinkStats), optionally start new collection"
+        with self.condition:
+            ret = dict((channel, stats.as_dict()) for channel, stats in self.stats.items()
+                       if channel is not None)
+            if reset:
+                self.stats = {}
+        return ret
+
+
 class BusHandler:
-    def __init__(self, logger, name='', out={}):
+    def __init__(self, logger, name='', out={}, raw_timestamps=False, log_policy={}, stats_period=None):
+        """
+        With raw_timestamps=True the messages are delivered with integer
+        timestamps in microseconds instead of timedelta.
+          The log_policy defines for selected outputs if all published
+        messages are logged ('all', default), none of them ('none'), every
+        Nth message ({'every': N}) or at most given rate ({'max_rate': Hz}).
+        Non-default policies are recorded in the info stream.
+          With stats_period (seconds) the statistics of inputs (see stats())
+        are written into stream <name>.bus_stats every stats_period, the
+        statistics are then collected for the last period only.
+        """
         self.logger = logger
-        self.queue = Queue()
+        self.raw_timestamps = raw_timestamps
+        self.queue = Mailbox()
         self.name = name
         self.out = out
         self.stream_id = {}
         for publish_name in out.keys():
             idx = self.logger.register('.'.join([self.name, publish_name]))
             self.stream_id[publish_name] = idx
+        self.log_policy = {}
+        for channel, policy in log_policy.items():
+            assert channel in out, (channel, list(out.keys()))
+            if check_log_policy(policy) != 'all':
+                self.log_policy[channel] = policy
+        if len(self.log_policy) > 0:
+            policy = dict(('.'.join([self.name, channel]), value) for channel, value in self.log_policy.items())
+            self.logger.write(INFO_STREAM_ID, bytes(str({'log_policy': policy}), encoding='ascii'))
+        self.log_count = {}
+        self.log_time = {}
+        self.publish_count = dict((channel, 0) for channel in out.keys())
+        self.stats_start = time.monotonic()
+        self.stats_period = stats_period
+        if stats_period is not None:
+            self.stats_stream_id = self.logger.register('.'.join([self.name, 'bus_stats']))
         self._is_alive = True
 
+    def should_log(self, channel):
+        policy = self.log_policy[channel]
+        if policy == 'none':
+            return False
+        if 'every' in policy:
+            count = self.log_count.get(channel, 0)
+            self.log_count[channel] = count + 1
+            return count % policy['every'] == 0
+        now = time.monotonic()
+        if channel in self.log_time and now - self.log_time[channel] < 1.0 / policy['max_rate']:
+            return False
+        self.log_time[channel] = now
+        return True
+
     def publish(self, channel, data):
+        """
+        log data and deliver them to all subscribers of the channel. With
+        asynchronous logger the data are serialized later, so neither the
+        publisher nor the subscribers may modify the published object.
+        """
         with self.logger.lock:
             stream_id = self.stream_id[channel]  # local maping of indexes
-            timestamp = self.logger.write(stream_id, serialize(data))
+            if channel in self.log_policy and not self.should_log(channel):
+                timestamp = self.logger.now_us()  # no serialization needed
+                if not self.raw_timestamps:
+                    timestamp = timedelta(microseconds=timestamp)
+            elif self.raw_timestamps:
+                timestamp = self.logger.write_object_us(stream_id, data)
+            else:
+                timestamp = self.logger.write_object(stream_id, data)
             for queue, input_channel in self.out[channel]:
                 queue.put((timestamp, input_channel, data))
+            self.publish_count[channel] += 1
 
-    def listen(self):
-        packet = self.queue.get()
-        if packet is None:
-            raise BusShutdownException()
-        timestamp, channel, data = packet
+    def publish_many(self, channel, items):
+        """
+        publish several messages of one channel at once, the timestamps,
+        logging and delivery are the same as for publish() of each item
+        """
+        if len(items) == 0:
+            return
+        if channel in self.log_policy:
+            for data in items:
+                self.publish(channel, data)
+            return
+        with self.logger.lock:
+            stream_id = self.stream_id[channel]
+            timestamps = self.logger.write_objects_us(stream_id, items)
+            if not self.raw_timestamps:
+                timestamps = [timedelta(microseconds=timestamp) for timestamp in timestamps]
+            for queue, input_channel in self.out[channel]:
+                queue.put_many([(timestamp, input_channel, data) for timestamp, data in zip(timestamps, items)])
+            self.publish_count[channel] += len(items)
+
+    def stats(self, reset=False):
+        """
+        return input statistics (channel -> count, dropped, max_depth and
+        latency histogram with LATENCY_BOUNDS), counts of published messages
+        (under key 'published') and duration of the collection in seconds
+        (under key 'duration') for computation of rates
+        """
+        ret = self.queue.get_stats(reset)
+        with self.logger.lock:
+            now = time.monotonic()
+            ret['published'] = dict(self.publish_count)
+            ret['duration'] = now - self.stats_start
+            if reset:
+                self.publish_count = dict((channel, 0) for channel in self.publish_count)
+                self.stats_start = now
+        return ret
+
+    def listen(self, timeout=None):
+        """
+        return the next message (timestamp, channel, data), with timeout
+        (seconds) return None if nothing arrived in time
+        """
+        packets = self.listen_many(1, timeout)
+        if len(packets) == 0:
+            return None
+        timestamp, channel, data = packets[0]
         return timestamp, channel, data
 
+    def listen_many(self, max_items=None, timeout=None):
+        """
+        return list of all pending messages (at most max_items), wait for at
+        least one, with timeout (seconds) return empty list if nothing
+        arrived in time
+        """
+        if self.stats_period is not None and time.monotonic() - self.stats_start >= self.stats_period:
+            self.logger.write_object(self.stats_stream_id, self.stats(reset=True))
+        try:
+            packets = self.queue.get_many(max_items, timeout)
+        except Empty:
+            return []
+        if packets[0] is None:
+            raise BusShutdownException()
+        return packets
+
     def is_alive(self):
         return self._is_alive
 
@@ -45,47 +305,97 @@ class BusHandler:
 
 
 class LogBusHandler:
-    def __init__(self, log, inputs, outputs):
+    def __init__(self, log, inputs, outputs, sparse_outputs=()):
+        """
+        Published data are compared with the logged outputs except
+        sparse_outputs (channel names), which were not logged completely.
+          The timeouts of listen() and listen_many() are derived from the log:
+        if the next logged record is an output, the module has published it
+        without new input, i.e. after timeout. The batch boundaries of
+        listen_many() are not logged: without timeout the batch contains the
+        next input and the inputs already buffered by publish(), with timeout
+        it contains the inputs logged before the next output.
+        """
         self.reader = log.read_gen(list(inputs.keys()) + list(outputs.keys()))
         self.inputs = inputs
         self.outputs = outputs
+        self.sparse_outputs = set(sparse_outputs)
         self.buffer_queue = Queue()
+        self.pending = None  # output record read by listen_many()
 
-    def listen(self):
-        if self.buffer_queue.empty():
-            dt, stream_id, bytes_data = next(self.reader)
-        else:
-            dt, stream_id, bytes_data = self.buffer_queue.get()
-        channel = self.inputs[stream_id]
-        data = deserialize(bytes_data)
-        return dt, channel, data
+    def read_record(self):
+        if self.pending is not None:
+            record, self.pending = self.pending, None
+            return record
+        return next(self.reader)
+
+    def listen(self, timeout=None):
+        packets = self.listen_many(1, timeout)
+        if len(packets) == 0:
+            return None
+        return packets[0]
+
+    def listen_many(self, max_items=None, timeout=None):
+        ret = []
+        while max_items is None or len(ret) < max_items:
+            if not self.buffer_queue.empty():
+                record = self.buffer_queue.get()
+            elif timeout is None:
+                if len(ret) > 0:
+                    break
+                record = self.read_record()
+            else:
+                try:
+                    record = self.read_record()
+                except StopIteration:
+                    if len(ret) > 0:
+                        break
+                    raise
+                if record[1] not in self.inputs:
+                    self.pending = record  # the output was published before the next input
+                    break
+            dt, stream_id, bytes_data = record
+            ret.append((dt, self.inputs[stream_id], deserialize(bytes_data)))
+        return ret
 
     def publish(self, channel, data):
+        if channel in self.sparse_outputs:
+            return
         assert channel in self.outputs.values(), (channel, self.outputs.values())
-        dt, stream_id, bytes_data = next(self.reader)
+        dt, stream_id, bytes_data = self.read_record()
         while stream_id not in self.outputs:
             assert stream_id in self.inputs, stream_id
             self.buffer_queue.put((dt, stream_id, bytes_data))
-            dt, stream_id, bytes_data = next(self.reader)
+            dt, stream_id, bytes_data = self.read_record()
         assert channel == self.outputs[stream_id], (channel, self.outputs[stream_id])  # wrong channel
         ref_data = deserialize(bytes_data)
         assert data == ref_data, (data, ref_data)
 
+    def publish_many(self, channel, items):
+        for data in items:
+            self.publish(channel, data)
+
 
 class LogBusHandlerInputsOnly:
     def __init__(self, log, inputs):
         self.reader = log.read_gen(inputs.keys())
         self.inputs = inputs
 
-    def listen(self):
+    def listen(self, timeout=None):
         dt, stream_id, bytes_data = next(self.reader)
         channel = self.inputs[stream_id]
         data = deserialize(bytes_data)
         return dt, channel, data
 
+    def listen_many(self, max_items=None, timeout=None):
+        return [self.listen()]  # without outputs the batches are not known
+
     def publish(self, channel, data):
         pass
 
+    def publish_many(self, channel, items):
+        pass
+
 
 if __name__ == "__main__":
     pass
@@ -87,8 +87,7 @@ class CANSerial(Thread):
                 dt, channel, data = self.bus.listen()
                 if channel == 'raw':
                     if len(data) > 0:
-                        for packet in self.process_gen(data):
-                            self.bus.publish('can', packet)
+                        self.bus.publish_many('can', list(self.process_gen(data)))
                 elif channel == 'can':
                     if self.can_bridge_initialized:
                         # at the moment is can serial just forwarding raw packets
@@ -34,6 +34,7 @@ class GPS(Thread):
 
         self.bus = bus
         self.buf = b''
+        self.timeout = config.get('timeout')  # seconds without data before INVALID_COORDINATES
 
     @staticmethod
     def parse_line(line):
@@ -71,7 +72,10 @@ class GPS(Thread):
     def run(self):
         try:
             while True:
-                packet = self.bus.listen()  # there should be some timeout and in case of failure send None
+                packet = self.bus.listen(self.timeout)
+                if packet is None:
+                    self.bus.publish('position', INVALID_COORDINATES)
+                    continue
                 dt, __, data = packet
                 for out in self.process_gen(data):
                     assert out is not None
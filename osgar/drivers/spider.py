@@ -125,9 +125,8 @@ class Spider(Thread):
                 dt, channel, data = self.bus.listen()
                 if channel == 'raw':
                     if len(data) > 0:
-                        for status in self.process_gen(data):
-                            if status is not None:
-                                self.bus.publish('status', status)
+                        self.bus.publish_many('status', [status for status in self.process_gen(data)
+                                                         if status is not None])
                 elif channel == 'move':
                     self.desired_speed, self.desired_angle = data
                 else:
@@ -4,7 +4,7 @@ from queue import Queue
 from datetime import timedelta
 
 from osgar.drivers.bus import (BusHandler, BusShutdownException,
-                               LogBusHandler, LogBusHandlerInputsOnly,
+                               LogBusHandler, LogBusHandlerInputsOnly, Mailbox,
                                serialize)
 
 from osgar.lib.serialize import serialize, deserialize
@@ -22,14 +22,26 @@ class BusHandlerTest(unittest.TestCase):
         logger.register = MagicMock(return_value=1)
         bus = BusHandler(logger, out={'raw':[]})
         bus.publish('raw', b'some binary data 2nd try')
-        logger.write.assert_called_once_with(1, b'\xc4\x18some binary data 2nd try')
+        logger.write_object.assert_called_once_with(1, b'some binary data 2nd try')
 
     def test_publish_serialization(self):
         logger = MagicMock()
         logger.register = MagicMock(return_value=1)
         bus = BusHandler(logger, out={'position':[]})
         bus.publish('position', (-123, 456))
-        logger.write.assert_called_once_with(1, b'\x92\xd0\x85\xcd\x01\xc8')
+        logger.write_object.assert_called_once_with(1, (-123, 456))
+
+    def test_publish_many(self):
+        logger = MagicMock()
+        logger.register = MagicMock(return_value=1)
+        logger.write_objects_us = MagicMock(return_value=[10, 11])
+        handler2 = BusHandler(logger)
+        handler1 = BusHandler(logger, out={'can':[(handler2.queue, 'raw')]})
+        handler1.publish_many('can', [b'\x01', b'\x02'])
+        logger.write_objects_us.assert_called_once_with(1, [b'\x01', b'\x02'])
+        self.assertEqual(handler2.listen(), (timedelta(microseconds=10), 'raw', b'\x01'))
+        self.assertEqual(handler2.listen(), (timedelta(microseconds=11), 'raw', b'\x02'))
+        self.assertEqual(handler1.stats()['published'], {'can': 2})
 
     def test_listen(self):
         logger = MagicMock()
@@ -42,11 +54,98 @@ class BusHandlerTest(unittest.TestCase):
         handler2 = BusHandler(logger)
         handler1 = BusHandler(logger, out={'raw':[(handler2.queue, 42)]})
 
-        logger.write = MagicMock(return_value=123)
+        logger.write_object = MagicMock(return_value=123)
         handler1.publish('raw', b"Hello!")
 
         self.assertEqual(handler2.listen(), (123, 42, b"Hello!"))
 
+    def test_raw_timestamps(self):
+        logger = MagicMock()
+        logger.write_object_us = MagicMock(return_value=123)
+        handler2 = BusHandler(logger)
+        handler1 = BusHandler(logger, out={'raw':[(handler2.queue, 42)]}, raw_timestamps=True)
+        handler1.publish('raw', b"Hello!")
+        logger.write_object.assert_not_called()
+        self.assertEqual(handler2.listen(), (123, 42, b"Hello!"))
+
+    def test_log_policy(self):
+        logger = MagicMock()
+        logger.register = MagicMock(side_effect=[1, 2, 3, 4])
+        logger.now_us = MagicMock(return_value=7)
+        bus = BusHandler(logger, name='serial', out={'raw':[], 'every':[], 'rate':[]},
+                         log_policy={'raw': 'none', 'every': {'every': 3}, 'rate': {'max_rate': 0.01}})
+        logger.write.assert_called_once_with(0, bytes(str({'log_policy': {
+                'serial.raw': 'none', 'serial.every': {'every': 3}, 'serial.rate': {'max_rate': 0.01}}}), 'ascii'))
+        for i in range(5):
+            for channel in ['raw', 'every', 'rate']:
+                bus.publish(channel, i)
+        self.assertEqual(logger.write_object.call_args_list, [((2, 0),), ((3, 0),), ((2, 3),)])
+
+        with self.assertRaises(AssertionError):
+            BusHandler(logger, out={'raw':[]}, log_policy={'raw': {'every': 0}})
+
+    def test_mailbox(self):
+        mailbox = Mailbox()
+        mailbox.set_policy('raw', 'fifo')
+        mailbox.set_policy('imu', 'latest')
+        mailbox.set_policy('gps', {'max_size': 2})
+        for i in range(5):
+            for channel in ['raw', 'imu', 'gps']:
+                mailbox.put((i, channel, i))
+        mailbox.put(None)
+        self.assertEqual([mailbox.get() for i in range(9)],
+                         [(0, 'raw', 0), (1, 'raw', 1), (2, 'raw', 2), (3, 'raw', 3), (3, 'gps', 3),
+                          (4, 'raw', 4), (4, 'imu', 4), (4, 'gps', 4), None])
+        self.assertTrue(mailbox.empty())
+
+        with self.assertRaises(AssertionError):
+            mailbox.set_policy('imu', 'fifo')  # conflicting policies of links
+        with self.assertRaises(AssertionError):
+            mailbox.set_policy('new', {'max_size': 0})
+
+    def test_stats(self):
+        logger = MagicMock()
+        logger.register = MagicMock(side_effect=[1, 2, 3])
+        handler2 = BusHandler(logger, name='app', stats_period=3600)
+        handler2.queue.set_policy('position', {'max_size': 2})
+        handler1 = BusHandler(logger, name='gps', out={'position':[(handler2.queue, 'position')]})
+        self.assertEqual(logger.register.call_args_list[0], (('app.bus_stats',),))
+        for i in range(3):
+            handler1.publish('position', [i, i])
+        handler2.listen()
+        stats = handler1.stats()
+        self.assertEqual(stats['published'], {'position': 3})
+        stats = handler2.stats()
+        self.assertEqual(stats['position']['count'], 1)
+        self.assertEqual(stats['position']['dropped'], 1)
+        self.assertEqual(stats['position']['max_depth'], 2)
+        self.assertEqual(sum(stats['position']['latency']), 1)
+
+        handler1.publish('position', [3, 3])
+        handler2.stats_period = 0.0
+        handler2.listen()  # the period has passed, statistics are logged and reset
+        stream_id, logged = logger.write_object.call_args[0]
+        self.assertEqual(stream_id, 1)
+        self.assertGreaterEqual(logged.pop('duration'), 0.0)
+        self.assertEqual(logged, {'published': {}, 'position': {'count': 1, 'dropped': 1, 'max_depth': 2,
+                                                                'latency': stats['position']['latency']}})
+        self.assertEqual(handler2.stats()['position']['count'], 1)
+        self.assertEqual(handler2.stats()['position']['dropped'], 0)
+
+    def test_listen_timeout(self):
+        logger = MagicMock()
+        handler = BusHandler(logger)
+        self.assertIsNone(handler.listen(timeout=0.01))
+        self.assertEqual(handler.listen_many(timeout=0.01), [])
+        for i in range(5):
+            handler.queue.put((i, 'raw', i))
+        handler.shutdown()
+        self.assertEqual(handler.listen_many(max_items=2), [(0, 'raw', 0), (1, 'raw', 1)])
+        self.assertEqual(handler.listen(timeout=0.01), (2, 'raw', 2))
+        self.assertEqual(handler.listen_many(), [(3, 'raw', 3), (4, 'raw', 4)])
+        with self.assertRaises(BusShutdownException):
+            handler.listen_many()
+
     def test_shutdown(self):
         logger = MagicMock()
         handler = BusHandler(logger)
@@ -59,7 +158,7 @@ class BusHandlerTest(unittest.TestCase):
         logger.register = MagicMock(return_value=1)
         bus = BusHandler(logger, name='gps_serial', out={'raw':[]})
         bus.publish('raw', b'bin data')
-        logger.write.assert_called_once_with(1, b'\xc4\x08bin data')
+        logger.write_object.assert_called_once_with(1, b'bin data')
 
     def test_alive(self):
         logger = MagicMock()
@@ -104,6 +203,41 @@ class BusHandlerTest(unittest.TestCase):
             bus.publish('can3', [1, 2])
         self.assertEqual(str(e.exception), "('can3', dict_values(['can', 'can2']))")
 
+    def test_log_bus_handler_sparse_outputs(self):
+        log = MagicMock()
+        log_data = [
+            (timedelta(microseconds=10), 1, serialize([1, 2])),
+            (timedelta(microseconds=30), 2, serialize([8, 9])),
+        ]
+        log.read_gen = MagicMock(return_value=iter(log_data))
+        bus = LogBusHandler(log, inputs={1:'raw'}, outputs={2:'can'}, sparse_outputs=['debug'])
+        bus.listen()
+        bus.publish('debug', [1, 2, 3])  # not logged, not checked
+        bus.publish('can', [8, 9])
+
+    def test_log_bus_handler_timeout(self):
+        log = MagicMock()
+        log_data = [
+            (timedelta(microseconds=10), 1, serialize([1, 2])),
+            (timedelta(microseconds=11), 1, serialize([3, 4])),
+            (timedelta(microseconds=30), 2, serialize(None)),
+            (timedelta(microseconds=40), 1, serialize([5, 6])),
+        ]
+        log.read_gen = MagicMock(return_value=iter(log_data))
+        bus = LogBusHandler(log, inputs={1:'raw'}, outputs={2:'can'})
+        self.assertEqual(bus.listen_many(), [(timedelta(microseconds=10), 'raw', [1, 2])])
+        self.assertEqual(bus.listen_many(timeout=0.1), [(timedelta(microseconds=11), 'raw', [3, 4])])
+        self.assertIsNone(bus.listen(timeout=0.1))  # output without input
+        bus.publish('can', None)
+        self.assertEqual(bus.listen(timeout=0.1), (timedelta(microseconds=40), 'raw', [5, 6]))
+
+        log.read_gen = MagicMock(return_value=iter(log_data))
+        bus = LogBusHandler(log, inputs={1:'raw'}, outputs={2:'can'})
+        bus.listen()
+        bus.publish('can', None)  # buffers the second input
+        self.assertEqual(bus.listen_many(), [(timedelta(microseconds=11), 'raw', [3, 4])])
+        self.assertEqual(bus.listen_many(), [(timedelta(microseconds=40), 'raw', [5, 6])])
+
     def test_log_bus_handler_inputs_onlye(self):
         log = MagicMock()
         log_data = [
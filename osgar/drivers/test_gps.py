@@ -1,5 +1,7 @@
 import unittest
+from unittest.mock import MagicMock
 
+from osgar.drivers.bus import BusShutdownException
 from osgar.drivers.gps import GPS, checksum, str2ms, INVALID_COORDINATES
 
 
@@ -42,4 +44,12 @@ class GPSTest(unittest.TestCase):
     def test_invalid_coordinates(self):
         self.assertEqual(GPS.parse_line(b'$GPGGA,053446.426,,,,,0,00,,,M,0.0,M,,0000*56'), INVALID_COORDINATES)
 
+    def test_timeout(self):
+        bus = MagicMock()
+        bus.listen = MagicMock(side_effect=[None, BusShutdownException()])
+        gps = GPS(config={'timeout': 0.5}, bus=bus)
+        gps.run()
+        bus.listen.assert_called_with(0.5)
+        bus.publish.assert_called_once_with('position', INVALID_COORDINATES)
+
 # vim: expandtab sw=4 ts=4
@@ -1,5 +1,6 @@
 import unittest
 from unittest.mock import MagicMock
+from datetime import timedelta
 
 from osgar.drivers.spider import Spider, CAN_packet
 from osgar.drivers.bus import BusHandler
@@ -28,7 +29,7 @@ class SpiderTest(unittest.TestCase):
     def test_publish_status(self):
         q = MagicMock()
         logger=MagicMock()
-        logger.write = MagicMock(return_value=135)
+        logger.write_objects_us = MagicMock(return_value=[135])
         bus = BusHandler(logger=logger, out={'status':[(q, 'status'),], 'can':[]})
         spider = Spider(config={}, bus=bus)
         spider.can_bridge_initialized = True  # skip initialization
@@ -36,6 +37,6 @@ class SpiderTest(unittest.TestCase):
         bus.queue.put((123, 'raw', b'@\x02\x00\x80'))
         bus.shutdown()
         spider.run()
-        q.put.assert_called_once_with((135, 'status', ([0x8000, None])))
+        q.put_many.assert_called_once_with([(timedelta(microseconds=135), 'status', [0x8000, None])])
 
 # vim: expandtab sw=4 ts=4
@@ -20,62 +20,681 @@
 # more than an hour of recording. The file contains absolute time and date in
 # the overall file header allowing splitting the file and getting absolute time
 # from deltas if necessary.
+#   Longer recordings are supported via "epoch" info records {'epoch': <n>}.
+# They are written whenever the upper bits of the time change and all following
+# timestamps are then ((n << 32) | timestamp). LogWriter can also split the
+# recording into several files (segments) by size or duration. Every segment
+# has its own start time and starts with a copy of all info records.
+#
+#   The version 2 of the format (magic "Pyr\x02") uses 64bit timestamps in
+# microseconds so the epoch records are not necessary. LogWriter with
+# clock='monotonic' computes the timestamps from time.monotonic() so they
+# are not affected by system time adjustments during the run.
 #
 #   The stream ID is currently just integer without detailed description. There
 # is planned extra info stored in "info channel/stream" ID = 0.
 #
-#   Finally limiting the block size to 65kB can be overcome by pre-reserved value
-# 0 and 0xFFFF. The big block could be then split into several smaller once. This
-# part is not defined yet.
+#   Finally limiting the block size to 65kB is overcome by pre-reserved value
+# 0xFFFF. The big block is split into several blocks of size 0xFFFF (meaning "to
+# be continued") followed by the last block smaller than 0xFFFF (possibly empty).
+# All blocks of the record have the same timestamp and stream ID and they are
+# always stored together.
+#
+#   LogWriter with async_write=True keeps only timestamping in the critical
+# section. Records (and objects for write_object()) are queued in the order
+# of the timestamps, serialized and processed (encoders, index, segments) by
+# the stage thread without the lock and stored in blocks by the writer thread.
+#
+#   For archiving the log can be converted into block compressed container
+# (compress_log(), CompressedLogReader). It has the same header with magic
+# "Pyz" and codec ID, followed by compressed blocks (about 1MB) of original
+# records. The block index at the end of the file lists time range and streams
+# of every block so only the necessary blocks are decompressed.
+#
+#   Random access is provided by an index stored in a sidecar file (log
+# filename + ".idx"). For every stream and every time bucket (1 second) it keeps
+# the offset of the first record in the bucket and its sequence number within
+# the stream. The index is either written by LogWriter on close or built and
+# saved by LogReader on first use.
+#
+#   Selected high-rate streams can be kept only in memory ("black box" mode).
+# LogWriter then stores the last few seconds of these streams in ring buffers
+# and dump_ring() writes them into a separate log file with the same start
+# time and info records, for example after an emergency stop.
+#
+#   Repetitive streams can be stored with encoders. The encoded record has the
+# highest bit of the stream ID set (ENCODED_FLAG) and its data are either empty
+# ("repeat the previous payload of the stream") or msgpack array of integer
+# differences to the previous payload (for flat integer arrays). The first
+# record of the stream in every index time bucket is always stored complete so
+# the reading can start at any index entry. The readers reconstruct the
+# original data transparently.
+#
+#   LogWriter finishes every file with a footer record (stream FOOTER_STREAM_ID,
+# ignored by readers). It contains msgpack dictionary with stream names, info
+# records, count and first/last timestamp of every stream. The data of the
+# footer end with its offset and FOOTER_MAGIC so it can be found from the end
+# of the file without reading the records.
+#
+#   Logs interrupted by power loss usually end with partial record (or garbage).
+# recover() finds the end of the last complete record by checking plausible
+# chains of records in the tail of the file, truncates the file and rebuilds
+# its index.
+#
+#   MultiLogReader merges several logs (segments or logs recorded by several
+# computers) into one time ordered stream. The times are aligned by the start
+# times in the file headers and the stream IDs are mapped by stream names.
+#
+#   extract_log() cuts time window and/or subset of streams into a new log with
+# the same header and info records. The records are copied as they are.
+#
+#   ConcurrentLogReader can be shared by several threads (viewer, statistics,
+# replay). It reads memory mapped file and each read_gen() is an independent
+# cursor, while the index and the catalog are loaded only once.
+#
+#   For repeated analysis export_columns() decodes the log once and stores every
+# stream as NumPy arrays (times and data) in directory next to the log (log
+# filename + ".npy"). load_columns() returns them memory mapped and refreshes
+# the cache when the log changed.
 #
 
 import datetime
+import lzma
+import mmap
+import os
 import struct
-from threading import RLock
+import time
+import zlib
+from ast import literal_eval
+from bisect import bisect_left, bisect_right
+from array import array
+from collections import deque
+from heapq import merge
+from functools import reduce
+from concurrent.futures import ProcessPoolExecutor
+from threading import Event, Lock, RLock, Thread
+from queue import Queue, Empty
+
+import numpy as np
+
+from osgar.lib.serialize import serialize, deserialize
 
 
 INFO_STREAM_ID = 0
 
+HEADER = struct.Struct('IHH')  # microseconds, stream_id, size
+HEADER_V2 = struct.Struct('QHH')
+FORMAT_HEADERS = {0: HEADER, 2: HEADER_V2}  # version byte of the file magic
+MAX_BLOCK_SIZE = 0xFFFF  # block of this size is continued by the next block
+ENCODED_FLAG = 0x8000  # stream ID bit of records encoded by previous payload
+FOOTER_STREAM_ID = 0x7FFF
+FOOTER_MAGIC = b'Pyf\x00'
+TIMESTAMP_MASK = 0xFFFFFFFF
+EPOCH_MARKER = b"{'epoch': "
+HEADERS_DTYPE = np.dtype([('offset', np.int64), ('microseconds', np.int64),
+                          ('stream_id', np.uint16), ('size', np.int64)])
+
+INDEX_MAGIC = b'Pyi\x00'
+COMPRESSED_MAGIC = b'Pyz\x00'
+COMPRESSED_BLOCK_SIZE = 0x100000
+BLOCK_HEADER = struct.Struct('II')  # compressed size, raw size
+BLOCK_ENTRY = struct.Struct('QIIQQH')  # offset, compressed and raw size, first and last time, number of streams
+CODECS = {'zlib': (1, zlib.compress, zlib.decompress),
+          'lzma': (2, lzma.compress, lzma.decompress)}
+INDEX_BUCKET = 1000000  # microseconds
+
+
+def epoch_marker(epoch):
+    "info record data defining upper 32 bits of following timestamps"
+    return bytes(str({'epoch': epoch}), encoding='ascii')
+
+
+def parse_epoch_marker(data):
+    "return epoch for epoch marker data, None for other info records"
+    if bytes(data[:len(EPOCH_MARKER)]) != EPOCH_MARKER:
+        return None
+    return int(bytes(data[len(EPOCH_MARKER):-1]))
+
+
+def file_header(start_time, version=1):
+    "magic and start time of the log file"
+    return (b'Pyr\x00' if version == 1 else b'Pyr\x02') + struct.pack(
+            'HBBBBBI', start_time.year, start_time.month, start_time.day,
+            start_time.hour, start_time.minute, start_time.second, start_time.microsecond)
+
+
+def encode_record(previous, bytes_data, delta=False):
+    "return encoded data based on the previous payload or None if not possible"
+    if bytes_data == previous:
+        return b''
+    if delta:
+        try:
+            prev, data = deserialize(previous), deserialize(bytes_data)
+        except Exception:
+            return None
+        if (isinstance(prev, list) and isinstance(data, list) and len(prev) == len(data) and
+                all(type(x) is int for x in prev + data) and serialize(data) == bytes_data):
+            encoded = serialize([b - a for a, b in zip(prev, data)])
+            if len(encoded) < len(bytes_data):
+                return encoded
+    return None
+
+
+def decode_record(previous, data):
+    "return original data of encoded record"
+    if len(data) == 0:
+        return previous
+    return serialize([a + b for a, b in zip(deserialize(previous), deserialize(data))])
+
+
+def split_record(microseconds, stream_id, bytes_data, header=HEADER):
+    "yield headers and data blocks of the record, large data are split"
+    view = memoryview(bytes_data)
+    while len(view) >= MAX_BLOCK_SIZE:
+        yield header.pack(microseconds, stream_id, MAX_BLOCK_SIZE)
+        yield view[:MAX_BLOCK_SIZE]
+        view = view[MAX_BLOCK_SIZE:]
+    yield header.pack(microseconds, stream_id, len(view))
+    yield view
+
+
+def record_size(bytes_data, header=HEADER):
+    "size of the record in the file including all headers"
+    return len(bytes_data) + header.size * (len(bytes_data) // MAX_BLOCK_SIZE + 1)
+
+
+def iter_records(data, offset=0, epoch=0, header=HEADER, previous=None, raw=False):
+    """
+    yield (end offset, microseconds, stream_id, data) of all complete records
+    in the buffer starting at given offset and epoch of timestamps,
+    previous is dictionary of the last payloads for decoding of encoded
+    records (records without known previous payload are skipped)
+    With raw=True the encoded records are yielded as stored (with ENCODED_FLAG).
+    """
+    if previous is None:
+        previous = {}
+    data_size = len(data)
+    unpack_from = header.unpack_from
+    header_size = header.size
+    while offset + header_size <= data_size:
+        microseconds, stream_id, size = unpack_from(data, offset)
+        record_end = offset + header_size + size
+        if record_end > data_size:
+            break  # incomplete record
+        if size < MAX_BLOCK_SIZE:
+            record_data = data[record_end - size:record_end]
+        else:
+            blocks = [data[record_end - size:record_end]]
+            while size == MAX_BLOCK_SIZE and record_end + header_size <= data_size:
+                size = unpack_from(data, record_end)[2]
+                record_end += header_size + size
+                blocks.append(data[record_end - size:record_end])
+            if size == MAX_BLOCK_SIZE or record_end > data_size:
+                break  # incomplete record
+            record_data = b''.join(blocks)  # large record has to be copied
+        offset = record_end
+        if stream_id == INFO_STREAM_ID:
+            marker = parse_epoch_marker(record_data)
+            if marker is not None:
+                epoch = marker
+        elif stream_id & ENCODED_FLAG and not raw:
+            stream_id &= ~ENCODED_FLAG
+            if stream_id not in previous:
+                continue
+            record_data = decode_record(previous[stream_id], record_data)
+        elif stream_id == FOOTER_STREAM_ID:
+            continue
+        previous[stream_id] = record_data
+        yield record_end, (epoch << 32) | microseconds, stream_id, record_data
+
+
+def stream_set(only_stream_id):
+    "set of selected streams (empty for all) from None, stream ID or list"
+    if only_stream_id is None:
+        return set()
+    try:
+        return set(only_stream_id)
+    except TypeError:
+        return set([only_stream_id])
+
+
+class LogIndex:
+    def __init__(self, bucket=INDEX_BUCKET):
+        self.bucket = bucket
+        self.entries = {}  # stream_id -> [(microseconds, offset, sequence number)]
+        self.counts = {}  # number of records per stream
+        self.last_bucket = {}
+        self.sequences = {}  # cached sequence numbers of entries
+
+    def add(self, microseconds, stream_id, offset):
+        seq = self.counts.get(stream_id, 0)
+        self.counts[stream_id] = seq + 1
+        bucket = microseconds // self.bucket
+        if self.last_bucket.get(stream_id) != bucket:
+            self.last_bucket[stream_id] = bucket
+            self.entries.setdefault(stream_id, []).append((microseconds, offset, seq))
+
+    def find(self, microseconds, stream_ids=None):
+        """
+        return (offset, time) of the record before the first record of given
+        streams not older than microseconds
+        """
+        if stream_ids is None:
+            stream_ids = self.entries.keys()
+        ret = None
+        for stream_id in stream_ids:
+            arr = self.entries.get(stream_id)
+            if arr:
+                i = max(0, bisect_left(arr, (microseconds + 1,)) - 1)
+                if ret is None or arr[i][1] < ret[0]:
+                    ret = arr[i][1], arr[i][0]
+        return ret
+
+    def find_sequence(self, stream_id, seq):
+        "return position of the entry with the record of given sequence number"
+        if stream_id not in self.sequences:
+            self.sequences[stream_id] = [entry[2] for entry in self.entries[stream_id]]
+        return bisect_right(self.sequences[stream_id], seq) - 1
+
+    def save(self, filename, log_size):
+        with open(filename, 'wb') as f:
+            f.write(INDEX_MAGIC)
+            f.write(struct.pack('QII', log_size, self.bucket, len(self.entries)))
+            for stream_id, arr in sorted(self.entries.items()):
+                f.write(struct.pack('IIH', self.counts[stream_id], len(arr), stream_id))
+                for entry in arr:
+                    f.write(struct.pack('QQI', *entry))
+
+    @staticmethod
+    def load(filename, log_size):
+        "return stored index or None if it does not match the log"
+        with open(filename, 'rb') as f:
+            if f.read(4) != INDEX_MAGIC:
+                return None
+            size, bucket, num_streams = struct.unpack('QII', f.read(16))
+            if size != log_size:
+                return None  # the index is outdated
+            index = LogIndex(bucket)
+            for i in range(num_streams):
+                count, num_entries, stream_id = struct.unpack('IIH', f.read(10))
+                index.counts[stream_id] = count
+                index.entries[stream_id] = [struct.unpack('QQI', f.read(20))
+                                            for j in range(num_entries)]
+        return index
+
 
 class LogWriter:
-    def __init__(self, prefix='naio', note=''):
-        self.lock = RLock()
+    def __init__(self, prefix='naio', note='', async_write=False,
+                 flush_interval=0.1, flush_size=0x10000, index=False,
+                 segment_size=None, segment_duration=None, clock='utc', version=1,
+                 ring_streams=(), ring_duration=datetime.timedelta(seconds=10),
+                 encoders={}):
+        """
+        With async_write=True the records are only timestamped and queued by
+        write() and write_object(). A dedicated thread serializes the objects
+        and keeps the bookkeeping (segments, rings, encoders, index) in the
+        order of the timestamps, while another thread stores the records
+        in larger blocks. The file is flushed at least every flush_interval
+        seconds or when flush_size bytes are collected. With index=True
+        the index sidecar file is created on close.
+          With segment_size (bytes of data) or segment_duration (timedelta)
+        the log is split into several files (segments), each with its own
+        start time and copy of info records (note, configuration, names).
+          With clock='monotonic' the timestamps are based on time.monotonic()
+        instead of system time. The version=2 selects 64bit timestamps.
+          Streams listed in ring_streams (stream IDs or registered names) are
+        not written to the file, but only the last ring_duration of them is
+        kept in memory and stored by dump_ring().
+          The encoders define for selected streams (stream IDs or registered
+        names) the encoding of repeated payloads ('repeat') or also integer
+        differences of numeric arrays ('delta').
+        """
+        assert clock in ['utc', 'monotonic'], clock
+        assert version in [1, 2], version
+        assert INFO_STREAM_ID not in ring_streams, ring_streams
+        assert INFO_STREAM_ID not in encoders, encoders
+        assert set(encoders.values()) <= set(['repeat', 'delta']), encoders
+        self.lock = RLock()  # timestamps and order of records
+        self.state_lock = Lock()  # names, rings and info records shared with the stage thread
+        self.error = None  # exception of the writer or stage thread
         self.start_time = datetime.datetime.utcnow()
-        self.filename = prefix + self.start_time.strftime("%y%m%d_%H%M%S.log")
-        self.f = open(self.filename, 'wb')
-        self.f.write(b'Pyr\x00')
-        
-        t = self.start_time
-        self.f.write(struct.pack('HBBBBBI', t.year, t.month, t.day,
-                t.hour, t.minute, t.second, t.microsecond))
-        self.f.flush()
+        self.start_monotonic = time.monotonic() if clock == 'monotonic' else None
+        self.version = version
+        self.header = HEADER if version == 1 else HEADER_V2
+        self.prefix = prefix
+        self.use_index = index
+        self.segment_size = segment_size
+        self.segment_duration = None
+        if segment_duration is not None:
+            self.segment_duration = segment_duration // datetime.timedelta(microseconds=1)
+        self.info_records = []  # repeated in every segment
+        self.ring_streams = set(ring_streams)
+        self.ring_duration = ring_duration // datetime.timedelta(microseconds=1)
+        self.rings = dict((stream_id, deque()) for stream_id in self.ring_streams
+                          if isinstance(stream_id, int))  # stream_id -> [(microseconds, stream_id, data)]
+        self.encoder_names = dict(encoders)
+        self.encoders = dict((stream_id, encoder) for stream_id, encoder in encoders.items()
+                             if isinstance(stream_id, int))
+        self.filenames = []
+        self.f = None
+        self.index = None
+
+        self.queue = None
+        self.stage = None
+        self.batch = False  # flush is postponed by write_objects_us()
+        if async_write:
+            self.flush_interval = flush_interval
+            self.flush_size = flush_size
+            self.queue = Queue()
+            self.writer_thread = Thread(target=self.run_writer, daemon=True)
+            self.writer_thread.start()
+            self.stage = Queue()  # (microseconds, stream_id, data, is_object) or Event
+            self.stage_thread = Thread(target=self.run_stage, daemon=True)
+            self.stage_thread.start()
+
+        self.open_segment(0)
         if len(note) > 0:
             self.write(stream_id=INFO_STREAM_ID, data=bytes(note, encoding='utf-8'))
         self.names = []
 
+    def open_segment(self, microseconds):
+        "close current file (if any) and continue in a new one"
+        t = self.start_time + datetime.timedelta(microseconds=microseconds)
+        filename = self.prefix + t.strftime("%y%m%d_%H%M%S.log")
+        if filename in self.filenames:  # several segments within one second
+            filename = self.prefix + t.strftime("%y%m%d_%H%M%S_%f.log")
+        f = open(filename, 'wb')
+        f.write(file_header(t, self.version))
+        f.flush()
+
+        if self.f is not None:
+            self.close_segment()
+        if self.queue is not None:
+            self.queue.put(f)  # the writer thread closes the previous file
+        self.f = f
+        self.filename = filename
+        self.filenames.append(filename)
+        self.segment_start = microseconds
+        self.offset = 16
+        self.epoch = 0
+        self.last_payload = {}  # stream_id -> (time bucket, data) for encoders
+        self.stream_info = {}  # stream_id -> [count, first, last] for footer
+        self.index = LogIndex() if self.use_index else None
+        with self.state_lock:
+            info_records = list(self.info_records)
+        for data in info_records:
+            self.write_record(0, INFO_STREAM_ID, data)
+        self.info_size = self.offset
+
+    def close_segment(self):
+        self.write_footer()
+        if self.queue is None:
+            self.f.close()
+        if self.index is not None:
+            self.index.save(self.filename + '.idx', self.offset)
+
+    def write_footer(self):
+        "write catalog of the segment as the last record"
+        with self.state_lock:
+            names, info_records = list(self.names), list(self.info_records)
+        footer = {'names': names, 'info': info_records,
+                  'streams': [[stream_id] + info for stream_id, info in sorted(self.stream_info.items())]}
+        microseconds = max([info[2] for info in self.stream_info.values()] + [0])
+        offset = self.offset
+        self.store_record(microseconds, FOOTER_STREAM_ID,
+                          serialize(footer) + struct.pack('Q', offset) + FOOTER_MAGIC)
+
     def register(self, name):
         with self.lock:
             assert name not in self.names, (name, self.names)
-            self.names.append(name)
+            assert len(self.names) + 1 < FOOTER_STREAM_ID, len(self.names)
+            with self.state_lock:
+                self.names.append(name)
+                stream_id = len(self.names)
+                if name in self.ring_streams:
+                    self.rings[stream_id] = deque()
+            if name in self.encoder_names:
+                self.encoders[stream_id] = self.encoder_names[name]
             self.write(stream_id=INFO_STREAM_ID, data=bytes(str({'names': self.names}), encoding='ascii'))
-            return len(self.names)
+            return stream_id
 
     def write(self, stream_id, data):
+        return datetime.timedelta(microseconds=self.write_us(stream_id, data))
+
+    def now_us(self):
+        "current time since the start of the recording in microseconds"
+        if self.start_monotonic is not None:
+            return int((time.monotonic() - self.start_monotonic) * 1000000)
+        dt = datetime.datetime.utcnow() - self.start_time
+        return dt // datetime.timedelta(microseconds=1)
+
+    def write_us(self, stream_id, data):
+        "write data and return the timestamp as integer microseconds"
+        self.raise_error()
         with self.lock:
-            dt = datetime.datetime.utcnow() - self.start_time
-            bytes_data = data
-            assert dt.days == 0, dt
-            assert dt.seconds < 3600, dt  # overflow not supported yet
-            assert len(bytes_data) < 0x10000, len(bytes_data)  # large data blocks are not supported yet
-            self.f.write(struct.pack('IHH', dt.seconds * 1000000 + dt.microseconds,
-                    stream_id, len(bytes_data)))
-            self.f.write(bytes_data)
-            self.f.flush()
-        return dt
+            microseconds = self.now_us()
+            if self.stage is not None:
+                self.stage.put((microseconds, stream_id, data, False))
+            else:
+                self.process_record(microseconds, stream_id, data)
+        return microseconds
+
+    def write_object(self, stream_id, data):
+        return datetime.timedelta(microseconds=self.write_object_us(stream_id, data))
+
+    def write_object_us(self, stream_id, data):
+        """
+        serialize data and write them, return the timestamp as integer
+        microseconds (in async_write mode the serialization is done later
+        by the stage thread, so the data must not be modified after the call)
+        """
+        if self.stage is None:
+            return self.write_us(stream_id, serialize(data))
+        self.raise_error()
+        with self.lock:
+            microseconds = self.now_us()
+            self.stage.put((microseconds, stream_id, data, True))
+        return microseconds
+
+    def write_objects_us(self, stream_id, items):
+        """
+        serialize and write several objects at once and return the list of
+        their timestamps (see write_object_us()), the file is flushed only
+        once for all of them
+        """
+        if self.stage is None:
+            items = [serialize(data) for data in items]
+        self.raise_error()
+        ret = []
+        with self.lock:
+            self.batch = True
+            try:
+                for data in items:
+                    microseconds = self.now_us()
+                    if self.stage is not None:
+                        self.stage.put((microseconds, stream_id, data, True))
+                    else:
+                        self.process_record(microseconds, stream_id, data)
+                    ret.append(microseconds)
+            finally:
+                self.batch = False
+            if self.stage is None:
+                self.f.flush()
+        return ret
+
+    def run_stage(self):
+        """
+        serialize queued objects and process records (async_write mode), the
+        first failure is raised by the next write or close()
+        """
+        while True:
+            item = self.stage.get()
+            if item is None:
+                self.stage.task_done()
+                break
+            if isinstance(item, Event):  # all records queued before are processed
+                item.set()
+                self.stage.task_done()
+                continue
+            microseconds, stream_id, data, is_object = item
+            try:
+                if is_object:
+                    data = serialize(data)
+                self.process_record(microseconds, stream_id, data)
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+            self.stage.task_done()
+
+    def process_record(self, microseconds, stream_id, data):
+        "split segments, keep rings and info records and write the record"
+        if ((self.segment_size is not None and self.offset - self.info_size >= self.segment_size) or
+                (self.segment_duration is not None and
+                 microseconds - self.segment_start >= self.segment_duration)):
+            self.open_segment(microseconds)
+        with self.state_lock:
+            if stream_id == INFO_STREAM_ID:
+                self.info_records.append(data)
+            ring = self.rings.get(stream_id)
+            if ring is not None:
+                ring.append((microseconds, stream_id, data))
+                while ring[0][0] < microseconds - self.ring_duration:
+                    ring.popleft()
+        if ring is None:
+            self.write_record(microseconds - self.segment_start, stream_id, data)
+
+    def dump_ring(self, note=''):
+        """
+        store content of ring buffers into a new log file and return its
+        filename, the note (trigger description) is added as the last info record
+        """
+        if self.stage is not None:
+            processed = Event()
+            self.stage.put(processed)
+            processed.wait()  # rings contain all records written before the trigger
+        microseconds = self.now_us()
+        with self.state_lock:
+            records = list(merge(*self.rings.values(), key=lambda record: record[0]))
+            for ring in self.rings.values():
+                ring.clear()
+            info_records = list(self.info_records)
+        if len(note) > 0:
+            records.append((microseconds, INFO_STREAM_ID, bytes(note, encoding='utf-8')))
+
+        t = self.start_time + datetime.timedelta(microseconds=microseconds)
+        filename = self.prefix + t.strftime("ring-%y%m%d_%H%M%S.log")
+        if os.path.exists(filename):  # several dumps within one second
+            filename = self.prefix + t.strftime("ring-%y%m%d_%H%M%S_%f.log")
+        with open(filename, 'wb') as f:
+            f.write(file_header(self.start_time, self.version))
+            for data in info_records:
+                f.writelines(split_record(0, INFO_STREAM_ID, data, self.header))
+            epoch = 0
+            for microseconds, stream_id, data in records:
+                if self.version == 1:
+                    if microseconds >> 32 != epoch:
+                        epoch = microseconds >> 32
+                        f.writelines(split_record(microseconds & TIMESTAMP_MASK, INFO_STREAM_ID,
+                                                  epoch_marker(epoch)))
+                    microseconds &= TIMESTAMP_MASK
+                f.writelines(split_record(microseconds, stream_id, data, self.header))
+        return filename
+
+    def write_record(self, microseconds, stream_id, bytes_data):
+        "write record with time relative to the start of the current segment"
+        if self.version == 1:
+            epoch = microseconds >> 32
+            if epoch != self.epoch:
+                self.epoch = epoch
+                self.write_record(microseconds, INFO_STREAM_ID, epoch_marker(epoch))
+        if self.index is not None:
+            self.index.add(microseconds, stream_id, self.offset)
+        info = self.stream_info.get(stream_id)
+        if info is None:
+            self.stream_info[stream_id] = [1, microseconds, microseconds]
+        else:
+            info[0] += 1
+            info[2] = microseconds
+        encoder = self.encoders.get(stream_id)
+        if encoder is not None:
+            bucket = microseconds // INDEX_BUCKET
+            last = self.last_payload.get(stream_id)
+            self.last_payload[stream_id] = bucket, bytes_data
+            if last is not None and last[0] == bucket:  # the first record in bucket is complete
+                encoded = encode_record(last[1], bytes_data, encoder == 'delta')
+                if encoded is not None:
+                    stream_id |= ENCODED_FLAG
+                    bytes_data = encoded
+        self.store_record(microseconds, stream_id, bytes_data)
+
+    def store_record(self, microseconds, stream_id, bytes_data):
+        self.offset += record_size(bytes_data, self.header)
+        if self.version == 1:
+            microseconds &= TIMESTAMP_MASK
+        if self.queue is not None:
+            self.queue.put((microseconds, stream_id, bytes_data))
+        else:
+            self.f.writelines(split_record(microseconds, stream_id, bytes_data, self.header))
+            if not self.batch:
+                self.f.flush()
+
+    def run_writer(self):
+        """
+        collect queued records and write them in blocks (async_write mode),
+        the first failure is raised by the next write or close()
+        """
+        f = None
+        chunks, size = [], 0
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                record = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+            except Empty:
+                record = ()  # nothing new, but it is time to flush
+            if record is None:
+                break  # close() was called
+            if not isinstance(record, tuple):  # new segment file
+                if f is not None:
+                    self.write_chunks(f, chunks, close=True)
+                    chunks, size = [], 0
+                f = record
+            elif len(record) > 0:
+                chunks.extend(split_record(*record, header=self.header))
+                size += record_size(record[2], self.header)
+            if size >= self.flush_size or time.monotonic() >= deadline:
+                if size > 0:
+                    self.write_chunks(f, chunks)
+                    chunks, size = [], 0
+                deadline = time.monotonic() + self.flush_interval
+        self.write_chunks(f, chunks, close=True)
+
+    def write_chunks(self, f, chunks, close=False):
+        "write chunks and flush (or close) the file, keep the failure for raise_error()"
+        try:
+            f.write(b''.join(chunks))
+            if close:
+                f.close()
+            else:
+                f.flush()
+        except Exception as e:
+            if self.error is None:
+                self.error = e
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
 
     def close(self):
-        self.f.close()
+        if self.stage is not None:
+            self.stage.put(None)
+            self.stage_thread.join()
+        self.close_segment()
+        if self.queue is not None:
+            self.queue.put(None)
+            self.writer_thread.join()
         self.f = None
+        self.raise_error()
 
 
     # context manager functions
@@ -87,34 +706,619 @@ class LogWriter:
 
 
 class LogReader:
+    def __init__(self, filename, follow=False):
+        """
+        With follow=True the reading does not stop at the end of the file, but
+        waits for new (complete) records stored by running LogWriter. Set
+        self.follow to False to finish the reading at the end of the file.
+        The reading also ends with the footer written by LogWriter.close().
+        """
+        self.filename = filename
+        self.follow = follow
+        self.poll_interval = 0.01
+        self.f = open(self.filename, 'rb')
+        data = self.f.read(4)
+        assert data[:3] == b'Pyr' and data[3] in FORMAT_HEADERS, data
+        self.header = FORMAT_HEADERS[data[3]]
+
+        data = self.f.read(12)
+        self.start_time = datetime.datetime(*struct.unpack('HBBBBBI', data))
+        self.index = None
+        self.epoch = 0  # upper bits of timestamps at current position
+        self.previous = {}  # last payloads of streams for encoded records
+        self.catalog = None
+
+    @property
+    def names(self):
+        "names of streams, stream ID is the position + 1"
+        return self.load_catalog()['names']
+
+    @property
+    def info_records(self):
+        "data of info stream records (note, configuration, names, ...)"
+        return self.load_catalog()['info']
+
+    @property
+    def streams(self):
+        "dictionary stream_id -> (count, first, last) with times in microseconds"
+        return self.load_catalog()['streams']
+
+    def read_footer(self):
+        "return footer dictionary stored by LogWriter or None if not available"
+        size = os.path.getsize(self.filename)
+        with open(self.filename, 'rb') as f:
+            f.seek(max(16, size - 12))
+            trailer = f.read(12)
+            if len(trailer) < 12 or trailer[8:] != FOOTER_MAGIC:
+                return None
+            offset = struct.unpack('Q', trailer[:8])[0]
+            if not 16 <= offset < size:
+                return None
+            f.seek(offset)
+            parts = []
+            while True:
+                header = f.read(self.header.size)
+                if len(header) < self.header.size:
+                    return None
+                __, stream_id, block_size = self.header.unpack(header)
+                if stream_id != FOOTER_STREAM_ID:
+                    return None
+                parts.append(f.read(block_size))
+                if block_size < MAX_BLOCK_SIZE:
+                    break
+        return deserialize(b''.join(parts)[:-12])
+
+    def load_catalog(self):
+        """
+        return dictionary with stream names, info records and streams, the data
+        are taken from the footer or collected by scanning the file (old logs)
+        """
+        if self.catalog is None:
+            footer = self.read_footer()
+            if footer is None:
+                with LogReader(self.filename) as log:
+                    info = [data for __, __, data in log.read_gen(INFO_STREAM_ID)
+                            if parse_epoch_marker(data) is None]
+                names = []
+                for data in info:
+                    if data.startswith(b"{'names': "):
+                        names = literal_eval(data.decode('ascii'))['names']
+                streams = [[stream_id, stats['count'], stats['first'], stats['last']]
+                           for stream_id, stats in self.stream_stats().items()]
+                footer = {'names': names, 'info': info, 'streams': streams}
+            self.catalog = {'names': footer['names'], 'info': footer['info'],
+                            'streams': dict((stream_id, (count, first, last))
+                                            for stream_id, count, first, last in footer['streams'])}
+        return self.catalog
+
+    def load_index(self):
+        "load index from sidecar file or build it (and store it) if not available"
+        if self.index is None:
+            index_filename = self.filename + '.idx'
+            log_size = os.path.getsize(self.filename)
+            if os.path.exists(index_filename):
+                self.index = LogIndex.load(index_filename, log_size)
+            if self.index is None:
+                self.index = self.build_index()
+                try:
+                    self.index.save(index_filename, log_size)
+                except OSError:
+                    pass  # read-only location - keep index only in memory
+        return self.index
+
+    def build_index(self):
+        index = LogIndex()
+        f = open(self.filename, 'rb')
+        offset = 16
+        continued = False
+        epoch = 0
+        f.seek(offset)
+        header_size = self.header.size
+        while True:
+            header = f.read(header_size)
+            if len(header) < header_size:
+                break
+            microseconds, stream_id, size = self.header.unpack(header)
+            stream_id &= ~ENCODED_FLAG
+            if not continued and stream_id != FOOTER_STREAM_ID:
+                if stream_id == INFO_STREAM_ID:
+                    marker = parse_epoch_marker(f.read(size))
+                    if marker is not None:
+                        epoch = marker
+                index.add((epoch << 32) | microseconds, stream_id, offset)
+            continued = (size == MAX_BLOCK_SIZE)
+            offset += header_size + size
+            f.seek(offset)
+        f.close()
+        return index
+
+    def bucket_records(self, stream_id, i):
+        "return list of records of the stream stored in the i-th index entry (bucket)"
+        entries = self.load_index().entries[stream_id]
+        microseconds, offset, __ = entries[i]
+        end = entries[i + 1][1] if i + 1 < len(entries) else os.path.getsize(self.filename)
+        with open(self.filename, 'rb') as f:
+            f.seek(offset)
+            data = f.read(end - offset)
+        return [(datetime.timedelta(microseconds=t), stream_id, record_data)
+                for __, t, record_stream_id, record_data in iter_records(data, 0, microseconds >> 32, self.header)
+                if record_stream_id == stream_id]
+
+    def get(self, stream_id, n):
+        """
+        return n-th record (time, stream, data) of the stream, negative n counts
+        from the end; only one index bucket is read
+        """
+        index = self.load_index()
+        count = index.counts.get(stream_id, 0)
+        if n < 0:
+            n += count
+        if not 0 <= n < count:
+            raise IndexError('record %d of stream %d out of range' % (n, stream_id))
+        i = index.find_sequence(stream_id, n)
+        return self.bucket_records(stream_id, i)[n - index.entries[stream_id][i][2]]
+
+    def read_reverse(self, stream_id, end_time=None):
+        """
+        generator of records of the stream from the end of the log (or from
+        end_time) to the beginning, the log is read by index buckets
+        """
+        entries = self.load_index().entries.get(stream_id, [])
+        i = len(entries) - 1
+        if end_time is not None:
+            end = end_time // datetime.timedelta(microseconds=1)
+            i = bisect_left(entries, (end + 1,)) - 1
+        for i in range(i, -1, -1):
+            for record in reversed(self.bucket_records(stream_id, i)):
+                if end_time is None or record[0] <= end_time:
+                    yield record
+
+    def parse_filter(self, only_stream_id, start_time, end_time):
+        """
+        return set of streams (empty for all), start and end in microseconds
+        and (offset, epoch) where to start reading (None for the current
+        position)
+        """
+        multiple_streams = stream_set(only_stream_id)
+        start, end, position = 0, None, None
+        if start_time is not None:
+            start = start_time // datetime.timedelta(microseconds=1)
+            position = self.load_index().find(start, multiple_streams or None)
+            if position is not None:
+                offset, microseconds = position
+                position = offset, microseconds >> 32
+        if end_time is not None:
+            end = end_time // datetime.timedelta(microseconds=1)
+        return multiple_streams, start, end, position
+
+    def scan_headers(self):
+        """
+        return numpy structured array (HEADERS_DTYPE) with headers of all
+        complete records in the file
+        """
+        if os.path.getsize(self.filename) <= 16:
+            return np.zeros(0, dtype=HEADERS_DTYPE)
+        with open(self.filename, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # only the chain of block offsets has to be walked sequentially
+            data_size = len(mm)
+            header_size = self.header.size
+            unpack_from = struct.Struct('H').unpack_from
+            offsets = array('q')
+            sizes = array('q')
+            offset = 16
+            while offset + header_size <= data_size:
+                size = unpack_from(mm, offset + header_size - 2)[0]
+                if offset + header_size + size > data_size:
+                    break  # incomplete block
+                offsets.append(offset)
+                sizes.append(size)
+                offset += header_size + size
+
+            offsets = np.frombuffer(offsets, dtype=np.int64)
+            sizes = np.frombuffer(sizes, dtype=np.int64)
+            # merge continuation blocks of large records
+            first = np.ones(len(offsets), dtype=bool)
+            first[1:] = sizes[:-1] != MAX_BLOCK_SIZE
+            if len(sizes) > 0 and sizes[-1] == MAX_BLOCK_SIZE:
+                n = np.nonzero(first)[0][-1]  # incomplete last record
+                offsets, sizes, first = offsets[:n], sizes[:n], first[:n]
+
+            raw = np.frombuffer(mm, dtype=np.uint8)
+            fields = raw[offsets[first][:, None] + np.arange(header_size - 2)]
+            del raw  # release the mmap buffer
+            time_size = header_size - 4
+            ret = np.zeros(np.count_nonzero(first), dtype=HEADERS_DTYPE)
+            ret['offset'] = offsets[first]
+            ret['microseconds'] = fields[:, :time_size].copy().view(
+                    np.uint32 if time_size == 4 else np.uint64)[:, 0]
+            ret['stream_id'] = fields[:, time_size:].copy().view(np.uint16)[:, 0] & (ENCODED_FLAG - 1)
+            ret['size'] = np.bincount(np.cumsum(first) - 1, weights=sizes, minlength=len(ret))
+
+            # upper bits of timestamps from (rare) epoch info records
+            info = np.nonzero((ret['stream_id'] == INFO_STREAM_ID) & (ret['size'] < MAX_BLOCK_SIZE))[0]
+            markers, epochs = [], []
+            for i in info.tolist():
+                offset = int(ret['offset'][i]) + header_size
+                epoch = parse_epoch_marker(mm[offset:offset + int(ret['size'][i])])
+                if epoch is not None:
+                    markers.append(i)
+                    epochs.append(epoch)
+        if len(markers) > 0:
+            i = np.searchsorted(markers, np.arange(len(ret)), side='right') - 1
+            epoch = np.where(i >= 0, np.array(epochs, dtype=np.int64)[i], 0)
+            ret['microseconds'] |= epoch << 32
+        return ret[ret['stream_id'] != FOOTER_STREAM_ID]
+
+    def stream_stats(self, headers=None):
+        """
+        return dictionary stream_id -> statistics (count, bytes, first and last
+        timestamp, average rate in Hz, inter-arrival jitter and maximal gap)
+        Times are in microseconds.
+        """
+        if headers is None:
+            headers = self.scan_headers()
+        streams, inverse, counts = np.unique(headers['stream_id'],
+                return_inverse=True, return_counts=True)
+        num = len(streams)
+        sizes = np.bincount(inverse, weights=headers['size'], minlength=num)
+
+        order = np.argsort(inverse, kind='stable')
+        group = inverse[order]
+        t = headers['microseconds'][order]
+        first = t[np.searchsorted(group, np.arange(num))]
+        last = t[np.searchsorted(group, np.arange(num), side='right') - 1]
+
+        same = group[1:] == group[:-1]
+        dt = np.diff(t)[same]
+        dt_group = group[1:][same]
+        dt_sum = np.bincount(dt_group, weights=dt, minlength=num)
+        dt_sum2 = np.bincount(dt_group, weights=dt.astype(np.float64)**2, minlength=num)
+        dt_count = counts - 1
+        mean = dt_sum / np.maximum(dt_count, 1)
+        jitter = np.sqrt(np.maximum(dt_sum2 / np.maximum(dt_count, 1) - mean**2, 0))
+        max_gap = np.zeros(num, dtype=np.int64)
+        np.maximum.at(max_gap, dt_group, dt)
+        duration = last - first
+        rate = np.where(duration > 0, dt_count * 1000000 / np.maximum(duration, 1), 0.0)
+
+        ret = {}
+        for i, stream_id in enumerate(streams.tolist()):
+            ret[stream_id] = {'count': int(counts[i]), 'bytes': int(sizes[i]),
+                    'first': int(first[i]), 'last': int(last[i]),
+                    'rate': float(rate[i]), 'jitter': float(jitter[i]),
+                    'max_gap': int(max_gap[i])}
+        return ret
+
+    def read_gen(self, only_stream_id=None, start_time=None, end_time=None):
+        """
+        packed generator - yields (time, stream, data)
+        start_time and end_time (timedelta) limit the time window, the start
+        is found via index.
+        """
+        multiple_streams, start, end, position = self.parse_filter(
+                only_stream_id, start_time, end_time)
+        if position is not None:
+            offset, self.epoch = position
+            self.f.seek(offset)
+        elif start_time is not None:
+            return  # no data for selected streams
+
+        header_size = self.header.size
+        while True:
+            record_offset = self.f.tell()
+            header = self.f.read(header_size)
+            if len(header) < header_size:
+                self.f.seek(record_offset)
+                if self.follow:
+                    time.sleep(self.poll_interval)
+                    continue
+                break
+            microseconds, stream_id, size = self.header.unpack(header)
+            encoded = stream_id & ENCODED_FLAG
+            stream_id &= ~ENCODED_FLAG
+            microseconds |= self.epoch << 32
+            if end is not None and microseconds > end:
+                self.f.seek(record_offset)  # keep the record for next reading
+                break
+            other_stream = (stream_id == FOOTER_STREAM_ID or
+                            (len(multiple_streams) > 0 and stream_id not in multiple_streams))
+            skip = microseconds < start or other_stream
+            # note, that skipping by seek would not detect incomplete record
+            # and skipped data of all streams may be needed for decoding (also
+            # by later read_gen() with different selection of streams)
+            data = self.read_data(size)
+            if data is None:
+                self.f.seek(record_offset)  # incomplete record
+                if self.follow:
+                    time.sleep(self.poll_interval)
+                    continue
+                break
+            if stream_id == FOOTER_STREAM_ID:
+                break  # the recording is finished
+            if stream_id == INFO_STREAM_ID:
+                epoch = parse_epoch_marker(data)
+                if epoch is not None:
+                    self.epoch = epoch
+                    microseconds = (epoch << 32) | (microseconds & TIMESTAMP_MASK)
+                    skip = microseconds < start or other_stream
+            elif stream_id != FOOTER_STREAM_ID:
+                if encoded:
+                    if stream_id not in self.previous:
+                        continue  # reading started after the first record of time bucket
+                    data = decode_record(self.previous[stream_id], data)
+                self.previous[stream_id] = data
+            if not skip:
+                yield datetime.timedelta(microseconds=microseconds), stream_id, data
+
+    def read_data(self, size):
+        """
+        read data of the record including continuation blocks,
+        return None for incomplete record
+        """
+        parts = []
+        while True:
+            parts.append(self.f.read(size))
+            if len(parts[-1]) < size:
+                return None
+            if size < MAX_BLOCK_SIZE:
+                break
+            header = self.f.read(self.header.size)
+            if len(header) < self.header.size:
+                return None
+            size = self.header.unpack(header)[2]
+        if len(parts) == 1:
+            return parts[0]
+        return b''.join(parts)
+
+    def close(self):
+        self.f.close()
+        self.f = None
+
+
+    # context manager functions
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class MmapLogReader(LogReader):
+    """
+    LogReader over memory mapped file. The data are yielded as memoryview
+    slices without copying, and they are valid until close(). Only records
+    larger than MAX_BLOCK_SIZE are joined into new bytes.
+    """
+    def __init__(self, filename):
+        LogReader.__init__(self, filename)
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.data = memoryview(self.mm)
+        self.offset = 16
+
+    def read_gen(self, only_stream_id=None, start_time=None, end_time=None):
+        "packed generator - yields (time, stream, memoryview of data)"
+        multiple_streams, start, end, position = self.parse_filter(
+                only_stream_id, start_time, end_time)
+        if position is not None:
+            self.offset, self.epoch = position
+        elif start_time is not None:
+            return  # no data for selected streams
+
+        for offset, microseconds, stream_id, data in iter_records(self.data, self.offset, self.epoch,
+                                                                  self.header, self.previous):
+            if end is not None and microseconds > end:
+                break
+            self.offset, self.epoch = offset, microseconds >> 32
+            if microseconds < start or (len(multiple_streams) > 0 and stream_id not in multiple_streams):
+                continue
+            yield datetime.timedelta(microseconds=microseconds), stream_id, data
+
+    def close(self):
+        self.data.release()
+        try:
+            self.mm.close()
+        except BufferError:
+            pass  # some slices are still referenced - the map is released with them
+        LogReader.close(self)
+
+
+class ConcurrentLogReader(MmapLogReader):
+    """
+    MmapLogReader shared by several threads. Every read_gen() is independent
+    cursor starting at the beginning of the log (or at start_time) and the
+    index and catalog are loaded only once.
+    """
+    def __init__(self, filename):
+        MmapLogReader.__init__(self, filename)
+        self.lock = RLock()
+
+    def load_index(self):
+        with self.lock:
+            return MmapLogReader.load_index(self)
+
+    def load_catalog(self):
+        with self.lock:
+            return MmapLogReader.load_catalog(self)
+
+    def read_gen(self, only_stream_id=None, start_time=None, end_time=None):
+        "packed generator - yields (time, stream, memoryview of data)"
+        multiple_streams, start, end, position = self.parse_filter(
+                only_stream_id, start_time, end_time)
+        if position is None:
+            if start_time is not None:
+                return  # no data for selected streams
+            position = 16, 0
+
+        offset, epoch = position
+        for offset, microseconds, stream_id, data in iter_records(self.data, offset, epoch, self.header):
+            if end is not None and microseconds > end:
+                break
+            if microseconds < start or (len(multiple_streams) > 0 and stream_id not in multiple_streams):
+                continue
+            yield datetime.timedelta(microseconds=microseconds), stream_id, data
+
+
+def compress_block(out, compress, raw):
+    "write compressed block, return its offset and size"
+    data = compress(raw)
+    out.write(BLOCK_HEADER.pack(len(data), len(raw)))
+    offset = out.tell()
+    out.write(data)
+    return offset, len(data), len(raw)
+
+
+def compress_log(filename, out_filename=None, codec='zlib',
+                 block_size=COMPRESSED_BLOCK_SIZE):
+    "convert log into block compressed container, return its filename"
+    if out_filename is None:
+        out_filename = filename + 'z'
+    codec_id, compress, __ = CODECS[codec]
+    blocks = []
+    with LogReader(filename) as log, open(out_filename, 'wb') as out:
+        log.f.seek(0)
+        header = log.f.read(16)
+        out.write(b'Pyz' + header[3:] + bytes([codec_id]))
+        if os.path.getsize(filename) > 16:
+            with mmap.mmap(log.f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                view = memoryview(mm)
+                block_start, first, streams = 16, None, set()
+                record_start = 16
+                for offset, microseconds, stream_id, data in iter_records(view, 16, 0, log.header):
+                    if first is None:
+                        first = microseconds
+                    streams.add(stream_id)
+                    streams.add(log.header.unpack_from(mm, record_start)[1])  # encoded records
+                    record_start = offset
+                    if offset - block_start >= block_size:
+                        blocks.append(compress_block(out, compress, mm[block_start:offset]) +
+                                      (first, microseconds, sorted(streams)))
+                        block_start, first, streams = offset, None, set()
+                if first is not None:
+                    blocks.append(compress_block(out, compress, mm[block_start:offset]) +
+                                  (first, microseconds, sorted(streams)))
+                data = None
+                view.release()
+
+        index_offset = out.tell()
+        for entry in blocks:
+            streams = entry[-1]
+            out.write(BLOCK_ENTRY.pack(*(entry[:-1] + (len(streams),))))
+            out.write(struct.pack('%dH' % len(streams), *streams))
+        out.write(struct.pack('Q', index_offset) + COMPRESSED_MAGIC)
+    return out_filename
+
+
+class CompressedLogReader:
+    """
+    Reader of block compressed log container. The interface is the same as
+    for LogReader, but only blocks with selected streams and time range are
+    decompressed.
+    """
     def __init__(self, filename):
         self.filename = filename
         self.f = open(self.filename, 'rb')
         data = self.f.read(4)
-        assert data == b'Pyr\x00', data
-        
+        assert data[:3] == b'Pyz' and data[3] in FORMAT_HEADERS, data
+        self.header = FORMAT_HEADERS[data[3]]
         data = self.f.read(12)
         self.start_time = datetime.datetime(*struct.unpack('HBBBBBI', data))
+        codec_id = self.f.read(1)[0]
+        self.decompress = [decompress for i, __, decompress in CODECS.values() if i == codec_id][0]
+        self.blocks = self.load_blocks()
+        self.position = (0, 0, 0)  # block, offset in block and epoch
+        self.previous = {}  # last payloads of streams for encoded records
+        self.skipped = False  # previous payloads are outdated due to skipped blocks
 
-    def read_gen(self, only_stream_id=None):
-        "packed generator - yields (time, stream, data)"
-        if only_stream_id is None:
-            multiple_streams = set()
-        else:
+    def load_blocks(self):
+        """
+        return list of (offset, compressed size, raw size, first, last, streams),
+        streams contain also IDs with ENCODED_FLAG if the block has encoded records
+        """
+        file_size = os.path.getsize(self.filename)
+        self.f.seek(max(17, file_size - 12))
+        trailer = self.f.read(12)
+        blocks = []
+        if trailer[8:] == COMPRESSED_MAGIC:
+            self.f.seek(struct.unpack('Q', trailer[:8])[0])
+            while self.f.tell() < file_size - 12:
+                entry = BLOCK_ENTRY.unpack(self.f.read(BLOCK_ENTRY.size))
+                num = entry[-1]
+                streams = set(struct.unpack('%dH' % num, self.f.read(2 * num)))
+                blocks.append(entry[:-1] + (streams,))
+            return blocks
+
+        # the index is missing (the conversion was interrupted) - scan blocks
+        offset, epoch = 17, 0
+        while offset + BLOCK_HEADER.size <= file_size:
+            self.f.seek(offset)
+            compressed_size, raw_size = BLOCK_HEADER.unpack(self.f.read(BLOCK_HEADER.size))
+            offset += BLOCK_HEADER.size
+            if offset + compressed_size > file_size:
+                break
             try:
-                multiple_streams = set(only_stream_id)
-            except TypeError:
-                multiple_streams = set([only_stream_id])
+                data = self.decompress(self.f.read(compressed_size))
+            except (zlib.error, lzma.LZMAError):
+                break  # beginning of incomplete block index
+            if len(data) != raw_size:
+                break
+            records = list(iter_records(data, 0, epoch, self.header))
+            if len(records) > 0:
+                epoch = records[-1][1] >> 32
+                blocks.append((offset, compressed_size, raw_size, records[0][1], records[-1][1],
+                               set([stream_id for __, __, stream_id, __ in records])))
+            offset += compressed_size
+        return blocks
 
-        while True:
-            header = self.f.read(8)
-            if len(header) < 8:
+    def read_gen(self, only_stream_id=None, start_time=None, end_time=None):
+        "packed generator - yields (time, stream, data)"
+        multiple_streams = stream_set(only_stream_id)
+        start, end = 0, None
+        if start_time is not None:
+            start = start_time // datetime.timedelta(microseconds=1)
+        if end_time is not None:
+            end = end_time // datetime.timedelta(microseconds=1)
+
+        block, offset, epoch = self.position
+        while block < len(self.blocks):
+            block_offset, compressed_size, raw_size, first, last, streams = self.blocks[block]
+            if end is not None and first > end:
                 break
-            microseconds, stream_id, size = struct.unpack('IHH', header)
-            dt = datetime.timedelta(microseconds=microseconds)
-            data = self.f.read(size)
-            if len(multiple_streams) == 0 or stream_id in multiple_streams:
-                yield dt, stream_id, data
+            if last < start or (len(multiple_streams) > 0 and multiple_streams.isdisjoint(streams)):
+                self.skipped = True
+                block, offset = block + 1, 0
+                self.position = (block, offset, epoch)
+                continue
+            if self.skipped and any(stream_id & ENCODED_FLAG for stream_id in streams):
+                self.warm_up(block)  # all streams of the block are decoded
+            self.skipped = False
+            self.f.seek(block_offset)
+            data = self.decompress(self.f.read(compressed_size))
+            if offset == 0:
+                epoch = first >> 32
+            for offset, microseconds, stream_id, record_data in iter_records(data, offset, epoch,
+                                                                             self.header, self.previous):
+                if end is not None and microseconds > end:
+                    return
+                epoch = microseconds >> 32
+                self.position = (block, offset, epoch)
+                if microseconds < start or (len(multiple_streams) > 0 and stream_id not in multiple_streams):
+                    continue
+                yield datetime.timedelta(microseconds=microseconds), stream_id, record_data
+            block, offset = block + 1, 0
+            self.position = (block, offset, epoch)
+
+    def warm_up(self, block):
+        "decode blocks from the beginning of the time bucket to get previous payloads"
+        first = self.blocks[block][3]
+        first_block = block
+        while first_block > 0 and self.blocks[first_block - 1][4] >= first - first % INDEX_BUCKET:
+            first_block -= 1
+        for block_offset, compressed_size, __, first, __, __ in self.blocks[first_block:block]:
+            self.f.seek(block_offset)
+            data = self.decompress(self.f.read(compressed_size))
+            for record in iter_records(data, 0, first >> 32, self.header, self.previous):
+                pass
 
     def close(self):
         self.f.close()
@@ -129,6 +1333,370 @@ class LogReader:
         self.close()
 
 
+class MultiLogReader:
+    """
+    Reader merging several logs into one stream ordered by time. The times
+    are relative to the earliest start time and stream IDs are positions in
+    merged list of stream names + 1 (info stream stays 0, unnamed streams keep
+    their ID). The names of the i-th log can be distinguished by prefixes[i].
+    """
+    def __init__(self, filenames, prefixes=None):
+        self.readers = [LogReader(filename) for filename in filenames]
+        if prefixes is None:
+            prefixes = [''] * len(self.readers)
+        self.start_time = min(log.start_time for log in self.readers)
+        self.names = []
+        self.stream_maps = []  # local stream ID -> merged stream ID
+        for log, prefix in zip(self.readers, prefixes):
+            stream_map = {}
+            for i, name in enumerate(log.names, start=1):
+                name = prefix + name
+                if name not in self.names:
+                    self.names.append(name)
+                stream_map[i] = self.names.index(name) + 1
+            self.stream_maps.append(stream_map)
+
+    def read_gen(self, only_stream_id=None, start_time=None, end_time=None):
+        "packed generator - yields (time, stream, data)"
+        multiple_streams = stream_set(only_stream_id)
+        gens = []
+        for log, stream_map in zip(self.readers, self.stream_maps):
+            shift = log.start_time - self.start_time
+            local_streams = None
+            if len(multiple_streams) > 0:
+                local_ids = dict((stream_id, local_id) for local_id, stream_id in stream_map.items())
+                local_streams = [stream_id for stream_id in multiple_streams
+                                 if stream_id == INFO_STREAM_ID or
+                                 (stream_id > len(self.names) and stream_id not in stream_map)]  # unnamed streams
+                local_streams += [local_ids[stream_id] for stream_id in multiple_streams
+                                  if stream_id in local_ids]
+                if len(local_streams) == 0:
+                    continue  # no selected stream in this log
+            gens.append(self.shifted_gen(log.read_gen(
+                    local_streams, None if start_time is None else max(start_time - shift, datetime.timedelta()),
+                    None if end_time is None else end_time - shift), shift, stream_map))
+        return merge(*gens, key=lambda record: record[0])
+
+    @staticmethod
+    def shifted_gen(gen, shift, stream_map):
+        for dt, stream_id, data in gen:
+            yield dt + shift, stream_map.get(stream_id, stream_id), data
+
+    def close(self):
+        for log in self.readers:
+            log.close()
+
+
+    # context manager functions
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def extract_log(filename, out_filename, only_stream_id=None, start_time=None, end_time=None):
+    """
+    write records of selected streams and time window into a new log with
+    the same start time and info records, return out_filename
+    The records are copied without change except the first encoded record
+    of every stream, which is stored complete.
+    """
+    with LogReader(filename) as log, open(out_filename, 'wb') as out, \
+            mmap.mmap(log.f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        multiple_streams, start, end, position = log.parse_filter(only_stream_id, start_time, end_time)
+        header = log.header
+        out.write(mm[:16])
+        for data in log.info_records:
+            out.writelines(split_record(0, INFO_STREAM_ID, data, header))
+
+        view = memoryview(mm)
+        offset, epoch = position or (16, 0)
+        out_epoch = 0
+        run_start = None  # start of records copied as one block
+        previous = {}  # last payloads of selected streams
+        complete = set()  # streams with complete record in the output
+        for record_end, microseconds, stream_id, data in iter_records(view, offset, epoch, header, raw=True):
+            if end is not None and microseconds > end:
+                break
+            record_start, offset = offset, record_end
+            local_stream_id = stream_id & ~ENCODED_FLAG
+            encoded = stream_id != local_stream_id
+            if stream_id == INFO_STREAM_ID:
+                selected = parse_epoch_marker(data) is not None  # other info records are already stored
+            else:
+                selected = len(multiple_streams) == 0 or local_stream_id in multiple_streams
+                if selected and encoded:
+                    data = decode_record(previous[local_stream_id], data) if local_stream_id in previous else None
+                if selected and data is not None:
+                    previous[local_stream_id] = data
+            selected = selected and data is not None and microseconds >= start
+            new_epoch = header is HEADER and stream_id != INFO_STREAM_ID and microseconds >> 32 != out_epoch
+            first_encoded = encoded and local_stream_id not in complete
+            if run_start is not None and (not selected or new_epoch or first_encoded):
+                out.write(mm[run_start:record_start])
+                run_start = None
+            if not selected:
+                continue
+            if new_epoch:
+                out.writelines(split_record(microseconds & TIMESTAMP_MASK, INFO_STREAM_ID,
+                                            epoch_marker(microseconds >> 32), header))
+            out_epoch = microseconds >> 32
+            complete.add(local_stream_id)
+            if first_encoded:
+                if header is HEADER:
+                    microseconds &= TIMESTAMP_MASK
+                out.writelines(split_record(microseconds, local_stream_id, data, header))
+            elif run_start is None:
+                run_start = record_start
+        if run_start is not None:
+            out.write(mm[run_start:offset])
+        previous = data = None
+        view.release()
+    return out_filename
+
+
+def scan_range(filename, start, end, epoch, only_stream_id, func, decode=True, decode_start=None):
+    """
+    call func(generator of (time, stream, data)) for records stored between
+    start and end offsets, epoch defines upper bits of the first timestamp
+    Encoded records are decoded from decode_start (offset, epoch).
+    """
+    if decode_start is None:
+        decode_start = start, epoch
+    multiple_streams = stream_set(only_stream_id)
+    with LogReader(filename) as log, \
+            mmap.mmap(log.f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)
+        records = ((datetime.timedelta(microseconds=microseconds), stream_id,
+                    deserialize(data) if decode and stream_id != INFO_STREAM_ID else bytes(data))
+                   for offset, microseconds, stream_id, data in iter_records(view[:end], *decode_start,
+                                                                             log.header)
+                   if offset > start and (len(multiple_streams) == 0 or stream_id in multiple_streams))
+        result = func(records)
+        records = None
+        view.release()
+    return result
+
+
+def map_log(filename, func, reduce_func=None, only_stream_id=None, decode=True,
+            workers=None, num_ranges=None):
+    """
+    Split the log into ranges (at record offsets from the index) and process
+    them by func(generator of (time, stream, data)) in parallel processes.
+    The data are deserialized unless decode=False. Return list of results
+    or their reduction by reduce_func(result1, result2).
+    Note, that func has to be picklable (i.e. defined on the module level).
+    """
+    with LogReader(filename) as log:
+        index = log.load_index()
+    stream_ids = stream_set(only_stream_id) or index.entries.keys()
+    points = sorted(set([(offset, microseconds >> 32, microseconds // index.bucket)
+                         for stream_id in stream_ids
+                         for microseconds, offset, __ in index.entries.get(stream_id, [])]))
+    if len(points) == 0:
+        return [] if reduce_func is None else None  # no records of selected streams
+    # decoding of encoded records starts with the first record of the time bucket
+    bucket_start = {}
+    for offset, epoch, bucket in points:
+        bucket_start.setdefault(bucket, (offset, epoch))
+    if workers is None:
+        workers = os.cpu_count()
+    if num_ranges is None:
+        num_ranges = 4 * workers
+    starts = sorted(set([points[len(points) * i // num_ranges] for i in range(num_ranges)]))
+    ends = [offset for offset, __, __ in starts[1:]] + [os.path.getsize(filename)]
+
+    with ProcessPoolExecutor(workers) as executor:
+        futures = [executor.submit(scan_range, filename, start, end, epoch, only_stream_id, func, decode,
+                                   bucket_start[bucket])
+                   for (start, epoch, bucket), end in zip(starts, ends)]
+        results = [future.result() for future in futures]
+    if reduce_func is None:
+        return results
+    return reduce(reduce_func, results)
+
+
+def columns_dir(filename):
+    "directory with cached columns of the log"
+    return filename + '.npy'
+
+
+def column_files(directory, name):
+    "filenames of time and data column of the stream"
+    return os.path.join(directory, name + '.time.npy'), os.path.join(directory, name + '.data.npy')
+
+
+def log_signature(filename):
+    "size and modification time of the log identifying valid cache"
+    stat = os.stat(filename)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def export_columns(filename, only_stream_id=None, dtypes={}):
+    """
+    decode the log once and store every stream as NumPy columns in directory
+    next to the log: times in microseconds (int64) and data array with one row
+    per record (nested arrays are flattened, i.e. IMU [[x, y, z]] * 4 gives
+    Nx12). Integer data are stored as int64, float data as float64 unless
+    dtypes (stream name -> dtype) says otherwise. Streams with data not fitting
+    regular array (bytes, dictionaries, None values) get only the time column.
+    The info stream is not exported. Return the directory.
+    """
+    multiple_streams = stream_set(only_stream_id)
+    with LogReader(filename) as log:
+        names = log.names
+        times, values = {}, {}
+        for stream_id in range(1, len(names) + 1):
+            if len(multiple_streams) == 0 or stream_id in multiple_streams:
+                times[stream_id], values[stream_id] = [], []  # also streams without records
+        for dt, stream_id, data in log.read_gen(only_stream_id):
+            if stream_id == INFO_STREAM_ID:
+                continue
+            times.setdefault(stream_id, []).append(dt // datetime.timedelta(microseconds=1))
+            values.setdefault(stream_id, []).append(deserialize(data))
+    directory = columns_dir(filename)
+    os.makedirs(directory, exist_ok=True)
+    for stream_id in times:
+        name = names[stream_id - 1] if 0 < stream_id <= len(names) else str(stream_id)
+        time_file, data_file = column_files(directory, name)
+        np.save(time_file, np.array(times[stream_id], dtype=np.int64))
+        try:
+            arr = np.array(values[stream_id])
+        except ValueError:
+            arr = None  # ragged data
+        if arr is not None and len(arr) > 0 and arr.dtype.kind in 'biuf':
+            if arr.ndim > 2:
+                arr = arr.reshape(len(arr), -1)
+            if name in dtypes:
+                arr = arr.astype(dtypes[name])
+            elif arr.dtype.kind != 'f':
+                arr = arr.astype(np.int64)
+            np.save(data_file, arr)
+        elif os.path.exists(data_file):
+            os.remove(data_file)
+    # the signature is written last so interrupted export is not used
+    np.save(os.path.join(directory, 'signature.npy'), log_signature(filename))
+    return directory
+
+
+def load_columns(filename, names, dtypes={}):
+    """
+    return dictionary stream name -> (times, data) of memory mapped columns,
+    data are None for streams without data column. The cache is exported
+    again if the log changed. KeyError is raised for names not in the log.
+    """
+    directory = columns_dir(filename)
+    signature = os.path.join(directory, 'signature.npy')
+    if (not os.path.exists(signature) or
+            not np.array_equal(np.load(signature), log_signature(filename)) or
+            not all(os.path.exists(column_files(directory, name)[0]) for name in names)):
+        with LogReader(filename) as log:
+            unknown = [name for name in names if name not in log.names]
+        if len(unknown) > 0:
+            raise KeyError(unknown)
+        export_columns(filename, dtypes=dtypes)
+    ret = {}
+    for name in names:
+        time_file, data_file = column_files(directory, name)
+        data = np.load(data_file, mmap_mode='r') if os.path.exists(data_file) else None
+        ret[name] = np.load(time_file, mmap_mode='r'), data
+    return ret
+
+
+def chain_end(data, offset, header, max_time, reached):
+    """
+    return (end offset, number of records) of the chain of plausible complete
+    records starting at offset, the walk stops at offsets already in reached
+    dictionary (offset -> (end, count) of previously checked chains)
+    """
+    data_size = len(data)
+    end, count, offsets = offset, 0, []
+    while offset + header.size <= data_size:
+        if offset in reached:
+            end, tail_count = reached[offset]
+            count += tail_count
+            break
+        microseconds, stream_id, size = header.unpack_from(data, offset)
+        record_end = offset + header.size + size
+        while size == MAX_BLOCK_SIZE and record_end + header.size <= data_size:
+            block_microseconds, block_stream_id, size = header.unpack_from(data, record_end)
+            if (block_microseconds, block_stream_id) != (microseconds, stream_id):
+                size = -1  # not continuation of the record
+                break
+            record_end += header.size + size
+        if (size < 0 or size == MAX_BLOCK_SIZE or record_end > data_size or microseconds > max_time or
+                stream_id & ~ENCODED_FLAG >= FOOTER_STREAM_ID or stream_id == ENCODED_FLAG or
+                (stream_id == INFO_STREAM_ID and size == 0)):
+            break  # incomplete or implausible record (empty info record is zero padding)
+        offsets.append(offset)
+        offset = end = record_end
+        count += 1
+    for i, offset in enumerate(offsets):
+        reached[offset] = end, count - i
+    return end, count
+
+
+def find_log_end(filename, window=0x100000, min_records=8):
+    """
+    return offset after the last complete record of the log, only the tail
+    (window) of the file is read if there is enough plausible records
+    """
+    size = os.path.getsize(filename)
+    with LogReader(filename) as log:
+        if log.read_footer() is not None:
+            return size  # properly closed log
+        header = log.header
+        duration = datetime.datetime.utcfromtimestamp(os.path.getmtime(filename)) - log.start_time
+        max_time = (duration + datetime.timedelta(minutes=1)) // datetime.timedelta(microseconds=1)
+        while True:
+            start = max(16, size - window)
+            log.f.seek(start)
+            data = log.f.read(size - start)
+            if start == 16:
+                return start + chain_end(data, 0, header, max_time, {})[0]
+
+            # vectorized pre-selection of possible record headers
+            num = max(0, len(data) - header.size + 1)
+            raw = np.frombuffer(data, dtype=np.uint8).astype(np.uint64)
+            time_size = header.size - 4
+            fields = []
+            for position, field_size in [(0, time_size), (time_size, 2), (time_size + 2, 2)]:
+                value = np.zeros(num, dtype=np.uint64)
+                for i in range(field_size):
+                    value |= raw[position + i:position + i + num] << np.uint64(8 * i)
+                fields.append(value)
+            microseconds, stream_id, block_size = fields
+            candidates = np.nonzero((microseconds <= max_time) &
+                                    ((stream_id & ~np.uint64(ENCODED_FLAG)) < FOOTER_STREAM_ID) &
+                                    (np.arange(num) + header.size + block_size <= len(data)))[0]
+            best, reached = 0, {}
+            for offset in candidates.tolist():
+                if offset not in reached:
+                    end, count = chain_end(data, offset, header, max_time, reached)
+                    if count >= min_records and end > best:
+                        best = end
+            if best > 0:
+                return start + best
+            window *= 4
+
+
+def recover(filename, window=0x100000):
+    """
+    truncate incomplete records at the end of the log (for example after
+    power loss), rebuild its index and return the number of removed bytes
+    """
+    size = os.path.getsize(filename)
+    end = find_log_end(filename, window)
+    if end < size:
+        with open(filename, 'r+b') as f:
+            f.truncate(end)
+        if os.path.exists(filename + '.idx'):
+            with LogReader(filename) as log:
+                log.load_index()  # the outdated index is rebuilt
+    return size - end
+
+
 class LogAsserter(LogReader):
     def __init__(self, filename):
         LogReader.__init__(self, filename)
@@ -142,18 +1710,55 @@ class LogAsserter(LogReader):
 if __name__ == "__main__":
     import argparse
     import sys
-    from osgar.lib.serialize import deserialize
 
     parser = argparse.ArgumentParser(description='Extract data from log')
     parser.add_argument('logfile', help='filename of stored file')
-    parser.add_argument('--stream', help='stream ID', type=int, default=None)
+    parser.add_argument('--stream', help='stream ID(s)', type=int, nargs='+', default=None)
+    parser.add_argument('--start', help='start time in seconds', type=float, default=None)
+    parser.add_argument('--end', help='end time in seconds', type=float, default=None)
     parser.add_argument('--times', help='display timestamps', action='store_true')
     parser.add_argument('--raw', help='skip data deserialization',
                         action='store_true')
+    parser.add_argument('--stats', help='print statistics of all streams',
+                        action='store_true')
+    parser.add_argument('--compress', help='convert to block compressed container',
+                        choices=sorted(CODECS.keys()))
+    parser.add_argument('--recover', help='truncate incomplete records at the end of the log',
+                        action='store_true')
+    parser.add_argument('--extract', help='write selected streams and time window into new log',
+                        metavar='OUTFILE')
+    parser.add_argument('--columns', help='export streams as NumPy columns',
+                        action='store_true')
     args = parser.parse_args()
+    start_time = None if args.start is None else datetime.timedelta(seconds=args.start)
+    end_time = None if args.end is None else datetime.timedelta(seconds=args.end)
+
+    if args.extract:
+        print(extract_log(args.logfile, args.extract, args.stream, start_time, end_time))
+        sys.exit()
+
+    if args.columns:
+        print(export_columns(args.logfile, args.stream))
+        sys.exit()
+
+    if args.recover:
+        print('Removed bytes:', recover(args.logfile))
+        sys.exit()
+
+    if args.compress:
+        print(compress_log(args.logfile, codec=args.compress))
+        sys.exit()
+
+    if args.stats:
+        with LogReader(args.logfile) as log:
+            names = log.names
+            for stream_id, stats in sorted(log.stream_stats().items()):
+                name = names[stream_id - 1] if 0 < stream_id <= len(names) else ''
+                print(stream_id, name, stats)
+        sys.exit()
 
     with LogReader(args.logfile) as log:
-        for timestamp, stream_id, data in log.read_gen(args.stream):
+        for timestamp, stream_id, data in log.read_gen(args.stream, start_time, end_time):
             if not args.raw and stream_id != 0:
                 data = deserialize(data)
             if args.times:
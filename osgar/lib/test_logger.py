@@ -1,10 +1,38 @@
 import unittest
 import os
+import shutil
 import time
 
 import numpy as np
 
-from osgar.lib.logger import LogWriter, LogReader, LogAsserter, INFO_STREAM_ID
+from datetime import timedelta
+
+from threading import Thread
+
+from osgar.lib.logger import (LogWriter, LogReader, LogAsserter, LogIndex,
+                              MmapLogReader, CompressedLogReader, compress_log,
+                              map_log, recover, iter_records, MultiLogReader, extract_log,
+                              ConcurrentLogReader, export_columns, load_columns,
+                              INFO_STREAM_ID, HEADER, FOOTER_MAGIC)
+from osgar.lib.serialize import serialize, deserialize
+
+
+def count_records(records):
+    "example of map_log() function"
+    counts = {}
+    for __, stream_id, data in records:
+        counts[stream_id] = counts.get(stream_id, 0) + 1
+    return counts
+
+
+def sum_counts(counts1, counts2):
+    for key, value in counts2.items():
+        counts1[key] = counts1.get(key, 0) + value
+    return counts1
+
+
+def extract_positions(records):
+    return [position for __, __, position in records]
 
 
 class LoggerTest(unittest.TestCase):
@@ -109,4 +137,745 @@ class LoggerTest(unittest.TestCase):
 
         os.remove(log.filename)
 
+    def test_async_write(self):
+        with LogWriter(prefix='tmp4', note='test_async_write', async_write=True,
+                       flush_interval=0.01, flush_size=100) as log:
+            filename = log.filename
+            times = []
+            for i in range(100):
+                times.append(log.write(1, bytes([i])*i))
+            time.sleep(0.05)  # let the writer thread flush some data
+            times.append(log.write(2, b'last'))
+
+        with LogReader(filename) as log:
+            arr = list(log.read_gen([1, 2]))
+            self.assertEqual([t for t, __, __ in arr], times)
+            self.assertEqual(arr[10][1:], (1, bytes([10])*10))
+            self.assertEqual(arr[-1][1:], (2, b'last'))
+
+        os.remove(filename)
+
+    def test_async_write_error(self):
+        log = LogWriter(prefix='tmp4', note='test_async_write_error', async_write=True,
+                        flush_interval=0.01, flush_size=100)
+        filename = log.filename
+        log.f.close()  # failing storage
+        log.write(1, b'first')
+        time.sleep(0.05)  # let the writer thread fail
+        with self.assertRaises(ValueError):
+            log.write(1, b'next')
+        log.write(1, b'last')
+        with self.assertRaises(ValueError):
+            log.close()
+        os.remove(filename)
+
+    def test_write_object(self):
+        for async_write in [False, True]:
+            with LogWriter(prefix='tmp25', note='test_write_object', async_write=async_write,
+                           ring_streams=[3]) as log:
+                filename = log.filename
+                ref = []
+                for i in range(100):
+                    ref.append((log.write_object(1, (-123, i)), 1, serialize([-123, i])))
+                    if i % 10 == 0:
+                        ref.append((log.write(2, bytes([i])), 2, bytes([i])))
+                    log.write_object(3, i)
+                times = log.write_objects_us(1, [(1, 2), (3, 4)])
+                ref.extend([(timedelta(microseconds=times[0]), 1, serialize([1, 2])),
+                            (timedelta(microseconds=times[1]), 1, serialize([3, 4]))])
+                ring_filename = log.dump_ring()
+
+            with LogReader(filename) as log:
+                self.assertEqual(list(log.read_gen([1, 2])), ref)
+            with LogReader(ring_filename) as log:
+                self.assertEqual([deserialize(data) for __, __, data in log.read_gen(3)], list(range(100)))
+            os.remove(filename)
+            os.remove(ring_filename)
+
+    def test_async_dump_ring(self):
+        with LogWriter(prefix='tmp25', note='test_async_dump_ring', async_write=True,
+                       ring_streams=[3]) as log:
+            filename = log.filename
+            for i in range(10):
+                log.write_object(3, i)
+            running = True
+
+            def publish():
+                i = 10
+                while running:
+                    log.write_object(3, i)
+                    i += 1
+            writer = Thread(target=publish, daemon=True)
+            writer.start()
+            ring_filename = log.dump_ring()  # does not wait for the queue to become empty
+            running = False
+            writer.join()
+
+        with LogReader(ring_filename) as log:
+            values = [deserialize(data) for __, __, data in log.read_gen(3)]
+        self.assertEqual(values[:10], list(range(10)))
+        self.assertEqual(values, list(range(len(values))))
+        os.remove(filename)
+        os.remove(ring_filename)
+
+    def test_stage_error(self):
+        log = LogWriter(prefix='tmp28', note='test_stage_error', async_write=True)
+        filename = log.filename
+        log.write_object(1, object())  # not serializable
+        log.stage.join()
+        with self.assertRaises(TypeError):
+            log.write_object(1, 'next')
+        log.write_object(1, object())
+        with self.assertRaises(TypeError):
+            log.close()
+        os.remove(filename)
+
+    def test_index(self):
+        index = LogIndex(bucket=10)
+        for microseconds, stream_id, offset in [(1, 1, 16), (2, 2, 24), (12, 1, 32),
+                                                (15, 1, 40), (21, 2, 48), (22, 1, 56)]:
+            index.add(microseconds, stream_id, offset)
+        self.assertEqual(index.entries[1], [(1, 16, 0), (12, 32, 1), (22, 56, 3)])
+        self.assertEqual(index.counts, {1: 4, 2: 2})
+        self.assertEqual(index.find(0), (16, 1))
+        self.assertEqual(index.find(13, [1]), (32, 12))
+        self.assertEqual(index.find(13, [2]), (24, 2))
+        self.assertEqual(index.find(13, [1, 2]), (24, 2))
+        self.assertEqual(index.find(30, [2]), (48, 21))
+        self.assertIsNone(index.find(30, [3]))
+
+    def test_read_time_window(self):
+        with LogWriter(prefix='tmp5', note='test_read_time_window', index=True) as log:
+            filename = log.filename
+            times = []
+            for i in range(5):
+                times.append(log.write(1 + i % 2, bytes([i])))
+                time.sleep(0.01)
+        self.assertTrue(os.path.exists(filename + '.idx'))
+
+        for with_sidecar in [True, False]:
+            with LogReader(filename) as log:
+                arr = list(log.read_gen(2, start_time=times[2]))
+                self.assertEqual(arr, [(times[3], 2, b'\x03')])
+                arr = list(log.read_gen(start_time=times[1], end_time=times[3]))
+                self.assertEqual([data for __, __, data in arr], [b'\x01', b'\x02', b'\x03'])
+                self.assertEqual(list(log.read_gen(end_time=times[4])), [(times[4], 1, b'\x04')])
+            os.remove(filename + '.idx')  # 2nd pass has to build the index
+        os.remove(filename)
+
+    def test_mmap_reader(self):
+        with LogWriter(prefix='tmp6', note='test_mmap_reader') as log:
+            filename = log.filename
+            for i in range(10):
+                log.write(1 + i % 3, bytes([i])*i)
+
+        with LogReader(filename) as log:
+            ref = list(log.read_gen([1, 3]))
+        with MmapLogReader(filename) as log:
+            arr = [(t, stream_id, bytes(data)) for t, stream_id, data in log.read_gen([1, 3])]
+            self.assertEqual(arr, ref)
+            self.assertEqual(len(arr), 7)
+            with self.assertRaises(StopIteration):
+                next(log.read_gen())  # continue reading after the last record
+        os.remove(filename)
+
+    def test_scan_headers(self):
+        with LogWriter(prefix='tmp7', note='test_scan_headers') as log:
+            filename = log.filename
+            for i in range(10):
+                log.write(1 + i % 2, bytes([i])*i)
+                time.sleep(0.001)
+
+        with LogReader(filename) as log:
+            ref = list(log.read_gen())
+            headers = log.scan_headers()
+            stats = log.stream_stats(headers)
+        self.assertEqual(len(headers), 11)  # including note
+        self.assertEqual(headers['offset'][:2].tolist(), [16, 16 + 8 + len('test_scan_headers')])
+        self.assertEqual(headers['stream_id'].tolist(), [stream_id for __, stream_id, __ in ref])
+        self.assertEqual(headers['size'].tolist(), [len(data) for __, __, data in ref])
+        self.assertEqual(headers['microseconds'].tolist(),
+                         [t // timedelta(microseconds=1) for t, __, __ in ref])
+
+        self.assertEqual(sorted(stats.keys()), [0, 1, 2])
+        self.assertEqual(stats[1]['count'], 5)
+        self.assertEqual(stats[1]['bytes'], 0 + 2 + 4 + 6 + 8)
+        self.assertEqual(stats[2]['first'], headers['microseconds'][2])
+        self.assertEqual(stats[2]['last'], headers['microseconds'][-1])
+        self.assertGreater(stats[2]['rate'], 0)
+        self.assertGreaterEqual(stats[2]['max_gap'], 2000)
+        self.assertEqual(stats[0]['rate'], 0)
+        os.remove(filename)
+
+    def test_large_block(self):
+        large = bytes(range(256)) * 1000
+        with LogWriter(prefix='tmp8', note='test_large_block') as log:
+            filename = log.filename
+            log.write(1, b'\x01')
+            t2 = log.write(2, large)
+            log.write(1, b'\x03')
+            log.write(2, bytes(0xFFFF))  # exactly one full block + empty one
+            log.write(1, b'\x05')
+
+        with LogReader(filename) as log:
+            arr = list(log.read_gen())
+            self.assertEqual(len(arr), 6)
+            self.assertEqual(arr[2], (t2, 2, large))
+            self.assertEqual(arr[4][2], bytes(0xFFFF))
+            self.assertEqual(arr[5][2], b'\x05')
+            self.assertEqual(log.build_index().counts, {0: 1, 1: 3, 2: 2})
+            headers = log.scan_headers()
+            self.assertEqual(headers['size'].tolist(), [len(data) for __, __, data in arr])
+        with MmapLogReader(filename) as log:
+            arr2 = [(t, stream_id, bytes(data)) for t, stream_id, data in log.read_gen()]
+            self.assertEqual(arr2, arr)
+
+        # cut the file in the middle of the large record
+        with open(filename, 'rb+') as f:
+            f.truncate(headers['offset'][2] + 70000)
+        with LogReader(filename) as log:
+            self.assertEqual(len(list(log.read_gen())), 2)
+            self.assertEqual(len(log.scan_headers()), 2)
+        with MmapLogReader(filename) as log:
+            self.assertEqual(len(list(log.read_gen())), 2)
+        os.remove(filename)
+
+    def test_long_recording(self):
+        with LogWriter(prefix='tmp9', note='test_long_recording') as log:
+            filename = log.filename
+            t1 = log.write(1, b'\x01')
+            log.start_time -= timedelta(hours=2)  # simulate timestamp overflow
+            t2 = log.write(1, b'\x02')
+            t3 = log.write(2, b'\x03')
+        self.assertGreater(t2, timedelta(hours=2))
+
+        with LogReader(filename) as log:
+            arr = list(log.read_gen())
+            self.assertEqual(arr[-1], (t3, 2, b'\x03'))
+            self.assertEqual(arr[-2], (t2, 1, b'\x02'))
+            self.assertEqual(arr[-3][1:], (INFO_STREAM_ID, b"{'epoch': 1}"))
+            self.assertEqual(list(log.read_gen(2, start_time=t2)), [(t3, 2, b'\x03')])
+            self.assertEqual(log.scan_headers()['microseconds'][-1], t3 // timedelta(microseconds=1))
+        with MmapLogReader(filename) as log:
+            self.assertEqual(list(log.read_gen(1))[-1], (t2, 1, b'\x02'))
+        os.remove(filename)
+        os.remove(filename + '.idx')
+
+    def test_epoch_zero(self):
+        with LogWriter(prefix='tmp9', note='test_epoch_zero') as log:
+            filename = log.filename
+            log.write_record((1 << 32) + 5, 1, b'a')
+            log.write_record(7, 1, b'b')  # {'epoch': 0} marker
+        with open(filename, 'rb') as f:
+            data = f.read()
+        self.assertEqual([(microseconds, data) for __, microseconds, stream_id, data in iter_records(data, 16)
+                          if stream_id == 1], [((1 << 32) + 5, b'a'), (7, b'b')])
+        with LogReader(filename) as log:
+            self.assertEqual([microseconds for microseconds, __, __ in log.build_index().entries[1]],
+                             [(1 << 32) + 5, 7])
+        os.remove(filename)
+
+    def test_segments(self):
+        with LogWriter(prefix='tmp10', note='test_segments', segment_size=90) as log:
+            self.assertEqual(log.register('raw'), 1)
+            times = [log.write(1, bytes(40)) for i in range(5)]
+            filenames = log.filenames
+            start_time = log.start_time
+        self.assertEqual(len(filenames), 3)
+
+        arr = []
+        for filename in filenames:
+            with LogReader(filename) as log:
+                records = list(log.read_gen())
+                info = [data for __, stream_id, data in records if stream_id == INFO_STREAM_ID]
+                self.assertEqual(info, [b'test_segments', b"{'names': ['raw']}"])
+                arr.extend([log.start_time + t for t, stream_id, __ in records if stream_id == 1])
+            os.remove(filename)
+        self.assertEqual(arr, [start_time + t for t in times])
+
+    def test_compressed_log(self):
+        with LogWriter(prefix='tmp11', note='test_compressed_log') as log:
+            filename = log.filename
+            for i in range(100):
+                log.write(1 + i // 50, bytes([i % 7]) * 50)
+            log.write(3, bytes(100000))
+        with LogReader(filename) as log:
+            ref = list(log.read_gen())
+
+        for codec in ['zlib', 'lzma']:
+            compressed_filename = compress_log(filename, codec=codec, block_size=1000)
+            self.assertLess(os.path.getsize(compressed_filename), os.path.getsize(filename) / 5)
+            with CompressedLogReader(compressed_filename) as log:
+                self.assertEqual(len(log.blocks), 6)
+                self.assertEqual(list(log.read_gen()), ref)
+
+        with CompressedLogReader(compressed_filename) as log:
+            calls = []
+            decompress = log.decompress
+            log.decompress = lambda data: calls.append(data) or decompress(data)
+            self.assertEqual(list(log.read_gen(2, start_time=ref[70][0], end_time=ref[80][0])),
+                             ref[70:81])
+            self.assertEqual(len(calls), 2)  # ~16 records per block
+            self.assertEqual(next(log.read_gen(3)), ref[-1])
+            self.assertEqual(len(calls), 3)
+
+        # missing block index
+        with open(compressed_filename, 'rb+') as f:
+            f.truncate(os.path.getsize(compressed_filename) - 20)
+        with CompressedLogReader(compressed_filename) as log:
+            self.assertEqual(list(log.read_gen()), ref)
+        os.remove(compressed_filename)
+        os.remove(filename)
+
+    def test_map_log(self):
+        with LogWriter(prefix='tmp12', note='test_map_log') as log:
+            filename = log.filename
+            for i in range(1000):
+                log.write(1 + i % 3, serialize([i, -i]))
+            log.start_time -= timedelta(seconds=10)  # more index buckets
+            for i in range(1000, 1500):
+                log.write(1 + i % 3, serialize([i, -i]))
+
+        self.assertEqual(map_log(filename, count_records, sum_counts, workers=2),
+                         {0: 1, 1: 500, 2: 500, 3: 500})
+        positions = map_log(filename, extract_positions, lambda a, b: a + b, only_stream_id=2,
+                            workers=2, num_ranges=3)
+        self.assertEqual(positions, [[i, -i] for i in range(1, 1500, 3)])
+        self.assertEqual(len(map_log(filename, count_records, workers=2, num_ranges=3)), 3)
+        self.assertIsNone(map_log(filename, count_records, sum_counts, only_stream_id=5, workers=2))
+        self.assertEqual(map_log(filename, count_records, only_stream_id=5, workers=2), [])
+        os.remove(filename)
+        os.remove(filename + '.idx')
+
+    def test_follow(self):
+        log = LogWriter(prefix='tmp13', note='test_follow')
+        reader = LogReader(log.filename, follow=True)
+        reader.poll_interval = 0.001
+
+        def producer():
+            time.sleep(0.01)
+            log.write(1, b'\x01\x02')
+            time.sleep(0.01)
+            log.f.write(HEADER.pack(123, 2, 4) + b'\x03')  # incomplete record
+            log.f.flush()
+            time.sleep(0.01)
+            log.f.write(b'\x04\x05\x06')
+            log.f.flush()
+
+        thread = Thread(target=producer)
+        thread.start()
+        gen = reader.read_gen([1, 2])
+        self.assertEqual(next(gen)[1:], (1, b'\x01\x02'))
+        self.assertEqual(next(gen), (timedelta(microseconds=123), 2, b'\x03\x04\x05\x06'))
+        thread.join()
+        reader.follow = False
+        with self.assertRaises(StopIteration):
+            next(gen)
+        reader.close()
+        log.close()
+        os.remove(log.filename)
+
+    def test_follow_until_close(self):
+        log = LogWriter(prefix='tmp29', note='test_follow_until_close')
+        reader = LogReader(log.filename, follow=True)
+        reader.poll_interval = 0.001
+        arr = []
+
+        def consumer():
+            for t, stream_id, data in reader.read_gen(1):
+                arr.append(data)
+
+        thread = Thread(target=consumer, daemon=True)
+        thread.start()
+        for i in range(3):
+            log.write(1, bytes([i]))
+            time.sleep(0.01)
+        log.close()
+        thread.join(timeout=1.0)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(arr, [b'\x00', b'\x01', b'\x02'])
+        reader.close()
+        os.remove(log.filename)
+
+    def test_format_v2(self):
+        with LogWriter(prefix='tmp14', note='test_format_v2', clock='monotonic', version=2) as log:
+            filename = log.filename
+            t1 = log.write_us(1, b'\x01')
+            log.start_monotonic -= 5000  # no overflow of 64bit time
+            t2 = log.write(2, b'\x02' * 70000)
+        self.assertIsInstance(t1, int)
+        self.assertGreater(t2, timedelta(seconds=5000))
+
+        with LogReader(filename) as log:
+            self.assertEqual(log.header.size, 12)
+            arr = list(log.read_gen())
+            self.assertEqual(arr[1:], [(timedelta(microseconds=t1), 1, b'\x01'),
+                                   (t2, 2, b'\x02' * 70000)])
+            self.assertEqual(log.scan_headers()['microseconds'].tolist(),
+                             [t // timedelta(microseconds=1) for t, __, __ in arr])
+            self.assertEqual(list(log.read_gen(start_time=t2)), arr[2:])
+        with MmapLogReader(filename) as log:
+            self.assertEqual([(t, stream_id, bytes(data)) for t, stream_id, data in log.read_gen()], arr)
+        with CompressedLogReader(compress_log(filename)) as log:
+            self.assertEqual(list(log.read_gen()), arr)
+        os.remove(filename + 'z')
+        os.remove(filename + '.idx')
+        os.remove(filename)
+
+    def test_ring_buffer(self):
+        with LogWriter(prefix='tmp15', note='test_ring_buffer', ring_streams=['raw', 3],
+                       ring_duration=timedelta(seconds=1)) as log:
+            filename = log.filename
+            self.assertEqual(log.register('raw'), 1)
+            self.assertEqual(log.register('pose'), 2)
+            log.write(1, b'old')
+            log.write(3, b'old3')
+            log.start_time -= timedelta(seconds=2)
+            log.write(2, b'pose')
+            t1 = log.write(1, b'raw')
+            t3 = log.write(3, b'raw3')
+            ring_filename = log.dump_ring('emergency stop')
+            empty_filename = log.dump_ring()  # rings were cleared
+            self.assertNotEqual(empty_filename, ring_filename)
+
+        with LogReader(filename) as log:
+            self.assertEqual([stream_id for __, stream_id, __ in log.read_gen()], [0, 0, 0, 2])
+        with LogReader(ring_filename) as log:
+            arr = list(log.read_gen())
+            self.assertEqual([(stream_id, data) for __, stream_id, data in arr],
+                             [(0, b'test_ring_buffer'), (0, b"{'names': ['raw']}"),
+                              (0, b"{'names': ['raw', 'pose']}"),
+                              (1, b'raw'), (3, b'raw3'), (0, b'emergency stop')])
+            self.assertEqual([t for t, __, __ in arr[3:5]], [t1, t3])
+        with LogReader(empty_filename) as log:
+            self.assertEqual(len(list(log.read_gen())), 3)
+        os.remove(empty_filename)
+        os.remove(ring_filename)
+        os.remove(filename)
+
+    def test_encoders(self):
+        status = [serialize(['ready', i // 150]) for i in range(300)]
+        positions = [[1000 + i, -5000 + i // 2, 7] for i in range(300)]
+        positions[50] = [0.5, 1]  # not integer array
+        with LogWriter(prefix='tmp16', note='test_encoders', index=True,
+                       encoders={'status': 'repeat', 'position': 'delta'}) as log:
+            filename = log.filename
+            for name in ['status', 'position', 'raw']:
+                log.register(name)
+            for i in range(300):
+                if i in [100, 200]:
+                    log.start_time -= timedelta(seconds=2)  # new index bucket
+                log.write(1, status[i])
+                log.write(2, serialize(positions[i]))
+                log.write(3, serialize(i))
+
+        with LogReader(filename) as log:
+            headers = log.scan_headers()
+            self.assertEqual(sorted(set(headers['stream_id'].tolist())), [0, 1, 2, 3])
+            self.assertEqual(np.count_nonzero(headers['size'][headers['stream_id'] == 1] > 0), 4)
+            self.assertLess(headers['size'][headers['stream_id'] == 2].sum(),
+                            0.6 * sum(len(serialize(p)) for p in positions))
+            arr = list(log.read_gen([1, 2]))
+            self.assertEqual([data for __, stream_id, data in arr if stream_id == 1], status)
+            self.assertEqual([deserialize(data) for __, stream_id, data in arr if stream_id == 2], positions)
+            start_time = [t for t, stream_id, __ in arr if stream_id == 2][150]
+        with LogReader(filename) as log:
+            self.assertEqual([deserialize(data) for __, __, data in log.read_gen(2, start_time=start_time)],
+                             positions[150:])
+        with MmapLogReader(filename) as log:
+            self.assertEqual([deserialize(data) for __, __, data in log.read_gen(2, start_time=start_time)],
+                             positions[150:])
+        with CompressedLogReader(compress_log(filename, block_size=1000)) as log:
+            self.assertEqual([deserialize(data) for __, __, data in log.read_gen(2, start_time=start_time)],
+                             positions[150:])
+        self.assertEqual(map_log(filename, extract_positions, lambda a, b: a + b, only_stream_id=2,
+                                 workers=2, num_ranges=5), positions)
+        os.remove(filename + 'z')
+        os.remove(filename + '.idx')
+        os.remove(filename)
+
+        with LogWriter(prefix='tmp16', note='test_encoders_resume', encoders={2: 'repeat'}) as log:
+            filename = log.filename
+            for stream_id, data in [(2, b'A'), (1, b'1'), (2, b'B'), (2, b'B'), (1, b'2'), (2, b'B')]:
+                log.write(stream_id, data)
+        compressed = compress_log(filename, block_size=10)
+        for reader in [LogReader(filename), MmapLogReader(filename), CompressedLogReader(compressed)]:
+            with reader as log:
+                self.assertEqual(next(log.read_gen([2]))[2], b'A')
+                self.assertEqual(next(log.read_gen([1]))[2], b'1')
+                self.assertEqual(next(log.read_gen([1]))[2], b'2')
+                self.assertEqual([bytes(data) for __, __, data in log.read_gen([2])], [b'B'])
+        os.remove(compressed)
+        os.remove(filename)
+
+    def test_footer(self):
+        with LogWriter(prefix='tmp17', note='test_footer') as log:
+            filename = log.filename
+            log.register('gps.position')
+            log.register('imu.orientation')
+            t1 = log.write(1, b'\x01')
+            log.write(2, b'\x02')
+            t2 = log.write(1, b'\x03')
+        with open(filename, 'rb') as f:
+            self.assertEqual(f.read()[-4:], FOOTER_MAGIC)
+
+        with LogReader(filename) as log:
+            log.read_gen = None  # the catalog is not collected by reading
+            self.assertEqual(log.names, ['gps.position', 'imu.orientation'])
+            self.assertEqual(log.info_records[0], b'test_footer')
+            self.assertEqual(log.streams[1], (2, t1 // timedelta(microseconds=1),
+                                              t2 // timedelta(microseconds=1)))
+        with LogReader(filename) as log:
+            arr = list(log.read_gen())
+            self.assertEqual([stream_id for __, stream_id, __ in arr], [0, 0, 0, 1, 2, 1])
+            self.assertEqual(sorted(log.stream_stats().keys()), [0, 1, 2])
+            footer_catalog = log.load_catalog()
+
+        # log without footer (old or not closed)
+        with open(filename, 'rb') as f:
+            data = f.read()
+        with open(filename, 'wb') as f:
+            f.write(data[:-30])
+        with LogReader(filename) as log:
+            self.assertEqual(list(log.read_gen()), arr)
+            self.assertEqual(log.load_catalog(), footer_catalog)
+        os.remove(filename)
+
+    def test_recover(self):
+        log = LogWriter(prefix='tmp18', note='test_recover', index=True)
+        filename = log.filename
+        for i in range(100):
+            log.write(1 + i % 3, serialize([i, 2 * i]))
+            if i % 30 == 29:
+                log.write(4, bytes(70000))
+        log.f.close()  # power loss - no footer
+        with open(filename, 'rb') as f:
+            data = f.read()
+        ends = [16] + [end for end, __, __, __ in iter_records(data, 16)]
+        large_end = [end for end, __, stream_id, __ in iter_records(data, 16) if stream_id == 4][-1]
+        with LogReader(filename) as log:
+            ref = list(log.read_gen())
+            log.load_index()  # sidecar of the complete file
+
+        for cut, garbage, window in [(len(data), b'', 1000), (len(data) - 1, b'', 1000),
+                                     (ends[-2] + 3, bytes(100), 1000), (large_end - 1000, b'', 1000),
+                                     (ends[-2] + 5, b'\xff' * 50, 100), (20, b'', 1000)]:
+            with open(filename, 'wb') as f:
+                f.write(data[:cut] + garbage)
+            end = max([end for end in ends if end <= cut])
+            self.assertEqual(recover(filename, window=window), cut + len(garbage) - end)
+            self.assertEqual(os.path.getsize(filename), end)
+            self.assertIsNotNone(LogIndex.load(filename + '.idx', end))
+            with LogReader(filename) as log:
+                self.assertEqual(list(log.read_gen()), ref[:ends.index(end)])
+            self.assertEqual(recover(filename), 0)
+        os.remove(filename)
+        os.remove(filename + '.idx')
+
+        log = LogWriter(prefix='tmp18', note='test_recover_empty')
+        filename = log.filename
+        log.write(1, b'a')
+        log.write(2, b'')  # valid empty record
+        for i in range(20):
+            log.write(1, bytes([i]) * 5)
+        log.f.write(HEADER.pack(123, 1, 10) + b'\x01')  # incomplete record
+        log.f.close()  # power loss - no footer
+        with LogReader(filename) as log:
+            ref = list(log.read_gen())
+        self.assertEqual(len(ref), 23)
+        self.assertEqual(recover(filename), HEADER.size + 1)
+        with LogReader(filename) as log:
+            self.assertEqual(list(log.read_gen()), ref)
+        os.remove(filename)
+
+    def test_multi_log_reader(self):
+        with LogWriter(prefix='tmp19', note='computer A', segment_size=100) as log_a:
+            log_a.register('gps.position')
+            log_a.register('imu.orientation')
+            time.sleep(0.05)
+            with LogWriter(prefix='tmp20', note='computer B') as log_b:
+                log_b.register('camera.raw')
+                log_b.register('gps.position')
+                for i in range(20):
+                    log_a.write(1 + i % 2, bytes([i]) * 10)
+                    log_b.write(1 + i % 2, bytes([100 + i]))
+        filenames = log_a.filenames + log_b.filenames
+        self.assertGreater(len(log_a.filenames), 2)
+
+        with MultiLogReader(filenames, prefixes=['']*(len(filenames) - 1) + ['b.']) as log:
+            self.assertEqual(log.start_time, log_a.start_time)
+            self.assertEqual(log.names, ['gps.position', 'imu.orientation', 'b.camera.raw', 'b.gps.position'])
+            arr = list(log.read_gen())
+            self.assertEqual([t for t, __, __ in arr], sorted([t for t, __, __ in arr]))
+            self.assertEqual([data[0] for __, stream_id, data in arr if stream_id == 1], list(range(0, 20, 2)))
+            self.assertEqual([data[0] for __, stream_id, data in arr if stream_id == 3], list(range(100, 120, 2)))
+            self.assertGreater(min(t for t, stream_id, __ in arr if stream_id == 3),
+                               log_b.start_time - log_a.start_time)
+        with MultiLogReader(filenames, prefixes=['']*(len(filenames) - 1) + ['b.']) as log:
+            self.assertEqual(list(log.read_gen(4)), [record for record in arr if record[1] == 4])
+
+        with MultiLogReader(filenames) as log:  # same names are merged
+            self.assertEqual(len(log.names), 3)
+            self.assertEqual(len(list(log.read_gen(1))), 20)
+        for filename in filenames:
+            os.remove(filename)
+
+    def test_multi_log_reader_name_order(self):
+        with LogWriter(prefix='tmp26', note='computer A') as log_a:
+            log_a.register('s')
+            log_a.register('a')
+            with LogWriter(prefix='tmp27', note='computer B') as log_b:
+                log_b.register('b')
+                log_b.register('s')
+                log_a.write(1, b's-from-A')
+                log_a.write(2, b'a-from-A')
+                log_b.write(1, b'b-from-B')
+                log_b.write(2, b's-from-B')
+        filenames = [log_a.filename, log_b.filename]
+        with MultiLogReader(filenames) as log:
+            self.assertEqual(log.names, ['s', 'a', 'b'])
+            self.assertEqual([(stream_id, data) for __, stream_id, data in log.read_gen(2)], [(2, b'a-from-A')])
+        with MultiLogReader(filenames) as log:
+            self.assertEqual(sorted(data for __, __, data in log.read_gen(1)), [b's-from-A', b's-from-B'])
+        with MultiLogReader(filenames) as log:
+            self.assertEqual([(stream_id, data) for __, stream_id, data in log.read_gen(3)], [(3, b'b-from-B')])
+        for filename in filenames:
+            os.remove(filename)
+
+    def test_extract_log(self):
+        with LogWriter(prefix='tmp21', note='test_extract_log', encoders={2: 'repeat'}) as log:
+            filename = log.filename
+            log.register('raw')
+            log.register('status')
+            for i in range(30):
+                if i == 10:
+                    log.start_time -= timedelta(seconds=2)
+                log.write(1, bytes([i]))
+                log.write(2, b'ready')
+                if i == 20:
+                    log.write(3, bytes(100000))
+            log.write_record((1 << 32) + 5000000, 1, b'last')  # next epoch
+        with LogReader(filename) as log:
+            original_start_time = log.start_time
+            arr = list(log.read_gen())
+            start_time = [t for t, stream_id, __ in arr if stream_id == 1][15]
+            end_time = arr[-2][0]
+
+        out_filename = filename[:-4] + '_cut.log'
+        self.assertEqual(extract_log(filename, out_filename, [2, 3], start_time, end_time), out_filename)
+        with LogReader(out_filename) as log:
+            self.assertEqual(log.start_time, original_start_time)
+            self.assertEqual(log.names, ['raw', 'status'])
+            self.assertEqual(list(log.read_gen([2, 3])),
+                             [r for r in arr if r[1] in [2, 3] and start_time <= r[0] <= end_time])
+            self.assertEqual(log.info_records[0], b'test_extract_log')
+
+        extract_log(filename, out_filename, start_time=arr[-2][0])
+        with LogReader(out_filename) as log:
+            self.assertEqual(list(log.read_gen(1)), [r for r in arr if r[1] == 1][-1:])
+        os.remove(out_filename)
+        os.remove(filename)
+        os.remove(filename + '.idx')
+
+    def test_concurrent_reader(self):
+        with LogWriter(prefix='tmp22', note='test_concurrent_reader') as log:
+            filename = log.filename
+            for i in range(1000):
+                log.write(1 + i % 2, serialize(i))
+                if i == 500:
+                    log.start_time -= timedelta(seconds=2)
+        with LogReader(filename) as log:
+            ref = list(log.read_gen())
+        start_time = ref[502][0]
+
+        with ConcurrentLogReader(filename) as log:
+            gen1, gen2 = log.read_gen(), log.read_gen(2)
+            arr1, arr2 = [], []
+            for record2, record1 in zip(gen2, gen1):  # interleaved reading
+                arr1.append(record1)
+                arr2.append(record2)
+            arr1.extend(gen1)
+            self.assertEqual([(t, s, bytes(d)) for t, s, d in arr1], ref)
+            self.assertEqual([(t, s, bytes(d)) for t, s, d in arr2], [r for r in ref if r[1] == 2])
+
+            results = [None] * 4
+            def worker(i):
+                results[i] = [(t, s, bytes(d)) for t, s, d in log.read_gen(start_time=start_time)]
+            threads = [Thread(target=worker, args=(i,)) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(results, [ref[502:]] * 4)
+            arr1 = arr2 = None
+        os.remove(filename)
+        os.remove(filename + '.idx')
+
+    def test_get_and_read_reverse(self):
+        with LogWriter(prefix='tmp23', note='test_get_and_read_reverse') as log:
+            filename = log.filename
+            for i in range(300):
+                if i % 100 == 99:
+                    log.start_time -= timedelta(seconds=2)  # more index buckets
+                log.write(1 + i % 3, serialize(i))
+        with LogReader(filename) as log:
+            ref = [record for record in log.read_gen() if record[1] == 2]
+        self.assertEqual(len(ref), 100)
+
+        with LogReader(filename) as log:
+            self.assertEqual(len(log.load_index().entries[2]), 3)
+            self.assertEqual([log.get(2, n) for n in range(100)], ref)
+            self.assertEqual(log.get(2, -1), ref[-1])
+            with self.assertRaises(IndexError):
+                log.get(2, 100)
+            self.assertEqual(list(log.read_reverse(2)), ref[::-1])
+            self.assertEqual(list(log.read_reverse(2, end_time=ref[50][0])), ref[50::-1])
+            self.assertEqual(list(log.read_reverse(4)), [])
+            self.assertEqual(list(log.read_gen(2)), ref)  # position is not changed
+        os.remove(filename)
+        os.remove(filename + '.idx')
+
+    def test_columns(self):
+        with LogWriter(prefix='tmp24', note='test_columns', encoders={1: 'delta'}) as log:
+            filename = log.filename
+            for name in ['gps.position', 'imu.orientation', 'gps.raw']:
+                log.register(name)
+            for i in range(10):
+                log.write(1, serialize([51000000 + i, 14000000 - i]))
+                log.write(2, serialize([[0.5 * i] * 3] * 4))
+                log.write(3, serialize(bytes([i])))
+        with LogReader(filename) as log:
+            ref = [(t // timedelta(microseconds=1), deserialize(d)) for t, __, d in log.read_gen([1, 2])]
+
+        directory = export_columns(filename, dtypes={'imu.orientation': np.float32})
+        self.assertEqual(directory, filename + '.npy')
+        columns = load_columns(filename, ['gps.position', 'imu.orientation', 'gps.raw'])
+        times, data = columns['gps.position']
+        self.assertIsInstance(times, np.memmap)
+        self.assertEqual(data.dtype, np.int64)
+        self.assertEqual(list(zip(times.tolist(), data.tolist())), ref[::2])
+        times, data = columns['imu.orientation']
+        self.assertEqual(data.dtype, np.float32)
+        self.assertEqual(data.shape, (10, 12))
+        self.assertEqual(list(zip(times.tolist(), data.tolist())),
+                         [(t, sum(d, [])) for t, d in ref[1::2]])
+        times, data = columns['gps.raw']
+        self.assertEqual(len(times), 10)
+        self.assertIsNone(data)
+        with self.assertRaises(KeyError):
+            load_columns(filename, ['imu.raw'])
+
+        export_columns(filename, [0, 1])  # info stream is not exported
+        self.assertFalse(os.path.exists(os.path.join(directory, '0.time.npy')))
+
+        with open(filename, 'ab') as f:  # the log has changed
+            f.write(b'\0' * 8)
+        times, data = load_columns(filename, ['imu.orientation'])['imu.orientation']
+        self.assertEqual(data.dtype, np.float64)  # exported again
+        columns = times = data = None
+        shutil.rmtree(directory)
+        os.remove(filename)
+        if os.path.exists(filename + '.idx'):
+            os.remove(filename + '.idx')
+
 # vim: expandtab sw=4 ts=4
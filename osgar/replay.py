@@ -17,18 +17,19 @@ from osgar.drivers import all_drivers
 
 def replay(args, application=None):
     log = LogReader(args.logfile)
-    print(next(log.read_gen(0))[-1])  # old arguments
-    config_str = next(log.read_gen(0))[-1]
-    config = literal_eval(config_str.decode('ascii'))
+    print(log.info_records[0])  # old arguments
+    config = literal_eval(log.info_records[1].decode('ascii'))
     if args.config is not None:
         config = config_load(*args.config)
 
-    names = []
-    for __, __, line in log.read_gen(0):
-        d = literal_eval(line.decode('ascii'))
-        if 'names' in d:
-            names = d['names']
+    names = log.names
+    log_policy = {}
+    for line in log.info_records[2:]:
+        if line.startswith(b"{'log_policy': "):
+            log_policy.update(literal_eval(line.decode('ascii'))['log_policy'])
     print(names)
+    if len(log_policy) > 0:
+        print('Sparse streams:', log_policy)
     
     module = args.module
     assert module in config['robot']['modules'], (module, config['robot']['modules'])
@@ -39,19 +40,20 @@ def replay(args, application=None):
     print(input_names, output_names)
 
     inputs = {}
-    for edge_from, edge_to in config['robot']['links']:
+    for edge_from, edge_to, *__ in config['robot']['links']:
         if edge_to.split('.')[0] == module:
             inputs[1 + names.index(edge_from)] = edge_to.split('.')[1]
     print(inputs)
 
-    outputs = dict([(1 + names.index('.'.join([module, name])), name) for name in output_names])
+    sparse_outputs = [name for name in output_names if '.'.join([module, name]) in log_policy]
+    outputs = dict([(1 + names.index('.'.join([module, name])), name) for name in output_names
+                    if name not in sparse_outputs])
     print(outputs)
 
-    log = LogReader(args.logfile)  # start reading log from the beginning again
     if args.force:
         bus = LogBusHandlerInputsOnly(log, inputs=inputs)
     else:
-        bus = LogBusHandler(log, inputs=inputs, outputs=outputs)
+        bus = LogBusHandler(log, inputs=inputs, outputs=outputs, sparse_outputs=sparse_outputs)
 
     driver_name = module_config['driver']
     if driver_name == 'application':
@@ -21,7 +21,9 @@ class Robot:
             out = {}
             for output_type in module_config['out']:
                 out[output_type] = []
-            bus = BusHandler(logger, out=out, name=module_name)
+            bus = BusHandler(logger, out=out, name=module_name,
+                             log_policy=module_config.get('log', {}),
+                             stats_period=module_config.get('stats_period'))
             que[module_name] = bus.queue
 
             module_class = module_config['driver']
@@ -32,9 +34,13 @@ class Robot:
                 module = all_drivers[module_class](module_config['init'], bus=bus)
             self.modules[module_name] = module
 
-        for from_module, to_module in config['links']:
+        for link in config['links']:
+            # optional third item is delivery policy: 'fifo' (default), {'max_size': N} or 'latest'
+            from_module, to_module = link[:2]
             (in_driver, in_name), (out_driver, out_name) = from_module.split('.'), to_module.split('.')
-            self.modules[in_driver].bus.out[in_name].append((self.modules[out_driver].bus.queue, out_name))
+            mailbox = self.modules[out_driver].bus.queue
+            mailbox.set_policy(out_name, link[2] if len(link) > 2 else 'fifo')
+            self.modules[in_driver].bus.out[in_name].append((mailbox, out_name))
 
     def start(self):
         for module in self.modules.values():
@@ -67,13 +73,14 @@ if __name__ == "__main__":
     if args.command == 'replay':
         pass  # TODO
     elif args.command == 'run':
-        log = LogWriter(prefix='robot-test-', note=str(sys.argv))
+        log = LogWriter(prefix='robot-test-', note=str(sys.argv), async_write=True)
         config = load(args.config)
         log.write(0, bytes(str(config), 'ascii'))  # write configuration
         robot = Robot(config=config['robot'], logger=log)
         robot.start()
         time.sleep(3.0)
         robot.finish()
+        log.close()
     else:
         assert False, args.command  # unsupported command
 
@@ -46,6 +46,22 @@ class RobotTest(unittest.TestCase):
             robot.update()
             robot.finish()
 
+    def test_link_policy(self):
+        config = {
+                'modules': {
+                    'gps': {'driver': 'gps', 'out': ['position'], 'init': {}},
+                    'app': {'driver': 'gps', 'out': [], 'init': {}}
+                },
+                'links': [('gps.position', 'app.raw', 'latest')]
+        }
+        robot = Robot(config=config, logger=MagicMock())
+        mailbox = robot.modules['app'].bus.queue
+        self.assertEqual(mailbox.policies, {'raw': 'latest'})
+        for i in range(3):
+            robot.modules['gps'].bus.publish('position', [i, i])
+        self.assertEqual(mailbox.get()[2], [2, 2])
+        self.assertTrue(mailbox.empty())
+
     def test_spider_config(self):
         # first example with loop spider <-> serial
         with open(os.path.dirname(__file__) + '/../config/test-spider.json') as f: